@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:52:30 2026
+
+benchmark of the chi-square of the 2x2 tables in CommonFxn.calc_chi2
+- per-row: stats.chi2_contingency for each table, the former implementation
+- vectorized: calc_chi2 over the whole arrays, including the BH and Holm adjustments
+synthetic tables like those of calc_stat are generated, 30% with single-digit cells
+the per-row version is run on the first n_ref tables and extrapolated, as 1e6 tables take minutes
+
+< How to use >
+python benchmarks/bench_chi2.py --n 1000000 --n_ref 20000
+
+@author: tadahaya
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from faersutil.src.calculator import CommonFxn
+
+def make_tables(n:int, seed:int=0):
+    """ n11, n12, n21, and n22 of the synthetic tables """
+    rng = np.random.default_rng(seed)
+    small = rng.random(n) < 0.3
+    n11 = np.where(small, rng.integers(1, 10, n), rng.integers(10, 5000, n))
+    n12 = np.where(small, rng.integers(1, 10, n), rng.integers(100, 50000, n))
+    n21 = rng.integers(100, 100000, n)
+    n22 = rng.integers(1000000, 10000000, n)
+    return n11, n12, n21, n22
+
+
+def per_row(n11, n12, n21, n22):
+    """ the former implementation """
+    contingency = np.stack([n11, n12, n21, n22], axis=1)
+    lst_chi = [stats.chi2_contingency(np.reshape(v, (2, 2))) for v in contingency]
+    return np.array([v[0] for v in lst_chi]), np.array([v[1] for v in lst_chi])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the chi-square of the 2x2 tables')
+    parser.add_argument('--n', type=int, default=1000000, help='the number of tables')
+    parser.add_argument('--n_ref', type=int, default=20000, help='the number of tables for the per-row version, all if 0')
+    args = parser.parse_args()
+    n_ref = args.n if args.n_ref <= 0 else min(args.n_ref, args.n)
+    tables = make_tables(args.n)
+    start = time.perf_counter()
+    chi, p, q_bh, q_holm = CommonFxn().calc_chi2(*tables)
+    t_vec = time.perf_counter() - start
+    start = time.perf_counter()
+    chi_ref, p_ref = per_row(*[v[:n_ref] for v in tables])
+    t_ref = time.perf_counter() - start
+    print(f"{args.n} tables")
+    print(f"   per-row: {t_ref:.2f} s for {n_ref} tables, {t_ref * args.n / n_ref:.1f} s for {args.n} (extrapolated)")
+    print(f"vectorized: {t_vec:.2f} s for {args.n} tables")
+    same = np.array_equal(chi[:n_ref], chi_ref) & np.array_equal(p[:n_ref], p_ref)
+    print(f"bit-identical on the {n_ref} tables:", same)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:31:47 2026
+
+benchmark of the expansion of records into drug-rxn relations in database.prep_drug_rxn
+- loop: _expand_loop, itertools.product for each record (--engine loop)
+- vector: _expand_vector, one split over the column and a cross join with numpy (default)
+synthetic records with names concatenated by '///' are generated,
+some drug names are not in the dict as in the real data
+
+< How to use >
+python benchmarks/bench_expand.py --n 200000
+
+@author: tadahaya
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def make_records(n:int, seed:int=0):
+    """ synthetic records and the dicts of the drugs and the reactions """
+    rng = np.random.default_rng(seed)
+    drugs = np.array([f"drug{i}" for i in range(3000)])
+    rxns = np.array([f"rxn{i}" for i in range(5000)])
+    def concat(pool, lo, hi):
+        k = rng.integers(lo, hi, n)
+        idx = rng.integers(0, len(pool), k.sum())
+        offset = np.concatenate([[0], np.cumsum(k)])
+        return ["///".join(pool[idx[offset[i]:offset[i + 1]]]) for i in range(n)]
+    sub = pd.DataFrame({
+        "case_id":np.arange(n), "active_substances":concat(drugs, 1, 6), "reactions":concat(rxns, 1, 5),
+        })
+    dic_drug = {k:i for i, k in enumerate(drugs[:2500])} # the rest are not found
+    dic_rxn = {k:i for i, k in enumerate(rxns)}
+    return sub, dic_drug, dic_rxn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the drug-rxn expansion')
+    parser.add_argument('--n', type=int, default=200000, help='the number of records')
+    parser.add_argument('--repeat', type=int, default=3, help='the best of this number of runs is shown')
+    args = parser.parse_args()
+    # database parses the command line at import
+    argv, sys.argv = sys.argv, [sys.argv[0], ROOT]
+    from faersutil import database
+    sys.argv = argv
+    sub, dic_drug, dic_rxn = make_records(args.n)
+    fxns = {"loop":database._expand_loop, "vector":database._expand_vector}
+    best = {k:float("inf") for k in fxns}
+    res = dict()
+    for _ in range(args.repeat):
+        for k, fxn in fxns.items():
+            start = time.perf_counter()
+            res[k] = fxn(sub, dic_drug, dic_rxn)
+            best[k] = min(best[k], time.perf_counter() - start)
+    df, n = res["vector"]
+    print(f"{args.n} records, {n} relations ({df.shape[0]} found), best of {args.repeat}")
+    for k, v in best.items():
+        print(f"{k:>7}: {v:.3f} s")
+    same = res["loop"][0].reset_index(drop=True).equals(df.reset_index(drop=True))
+    print("identical:", same & (res["loop"][1] == n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:05:12 2026
+
+benchmark of the safetyreport field extraction (Loader2014Q3_._parse_reports)
+- single-pass: ReportExtractor, one visit per report
+- eight-pass: the former loader, one loop over the reports for each field
+a synthetic ADR XML file with FAERS-like filler elements is generated
+
+< How to use >
+python benchmarks/bench_xml_extract.py --n 100000
+
+@author: tadahaya
+"""
+import os
+import gc
+import sys
+import time
+import random
+import argparse
+import tempfile
+import xml.etree.ElementTree as ET
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from faersutil.src import xml_loader as xl
+
+DRUGS = ["Aspirin", "IBUPROFEN", "acetaminophen\\caffeine", "Warfarin", "metformin or insulin", "Heparin"]
+RXNS = ["Nausea", "Headache", "Rash", "Hepatitis", "Death"]
+
+def make_xml(url:str, n:int, seed:int=0):
+    """ write a synthetic ADR XML file of n safetyreports """
+    r = random.Random(seed)
+    with open(url, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<ichicsr lang="en">\n')
+        f.write("<ichicsrmessageheader><messagetype>x</messagetype></ichicsrmessageheader>\n")
+        for i in range(n):
+            f.write("<safetyreport><safetyreportversion>1</safetyreportversion>")
+            f.write(f"<safetyreportid>{1000000 + i}</safetyreportid><primarysourcecountry>US</primarysourcecountry>")
+            if r.random() < 0.8:
+                f.write(f"<occurcountry>{r.choice(['US', 'JP', 'GB'])}</occurcountry>")
+            f.write("<transmissiondate>20150101</transmissiondate><reporttype>1</reporttype><serious>1</serious>")
+            f.write("<receivedate>20150101</receivedate><companynumb>X-1</companynumb><duplicate>1</duplicate>")
+            f.write("<primarysource><reportercountry>US</reportercountry>")
+            if r.random() < 0.8:
+                f.write(f"<qualification>{r.randint(1, 5)}</qualification>")
+            f.write("</primarysource><sender><sendertype>2</sendertype><senderorganization>FDA</senderorganization></sender>")
+            f.write("<receiver><receivertype>6</receivertype></receiver><patient>")
+            if r.random() < 0.7:
+                f.write(f"<patientonsetage>{r.randint(1, 99)}</patientonsetage>")
+            if r.random() < 0.9:
+                f.write(f"<patientsex>{r.randint(1, 2)}</patientsex>")
+            for _ in range(r.randint(1, 6)):
+                f.write("<reaction><reactionmeddraversionpt>18.0</reactionmeddraversionpt>")
+                f.write(f"<reactionmeddrapt>{r.choice(RXNS)}</reactionmeddrapt></reaction>")
+            for _ in range(r.randint(0, 8)):
+                f.write("<drug><drugcharacterization>1</drugcharacterization><medicinalproduct>X</medicinalproduct>")
+                f.write("<drugdosagetext>x</drugdosagetext><drugindication>y</drugindication><actiondrug>5</actiondrug>")
+                if r.random() < 0.9:
+                    f.write(f"<activesubstance><activesubstancename>{r.choice(DRUGS)}</activesubstancename></activesubstance>")
+                f.write("</drug>")
+            if r.random() < 0.6:
+                f.write(f"<summary><narrativeincludeclinical>CASE EVENT DATE: 2015{r.randint(1, 12):02d}</narrativeincludeclinical></summary>")
+            f.write("</patient></safetyreport>\n")
+        f.write("</ichicsr>\n")
+
+
+def eight_pass(saftyreports:list):
+    """ the former extraction, one loop over the reports for each field """
+    def text(ele):
+        return '' if ele is None else ele.text
+    caseID = [v.find('safetyreportid').text for v in saftyreports]
+    event_country = [text(v.find('occurcountry')) for v in saftyreports]
+    event_date = []
+    for v in saftyreports:
+        c = v.find('patient').find('summary')
+        event_date.append('' if c is None else c[0].text.replace('CASE EVENT DATE: ',''))
+    age = [text(v.find('patient').find('patientonsetage')) for v in saftyreports]
+    sex = []
+    for v in saftyreports:
+        c = v.find('patient').find('patientsex')
+        sex.append('' if c is None else ('Male' if str(c.text)=='1' else 'Female'))
+    reactions = []
+    for v in saftyreports:
+        c = [w.find('reactionmeddrapt') for w in v.find('patient').findall('reaction')]
+        reactions.append(";".join([d.text for d in c if d is not None]).lower())
+    drugs = []
+    for v in saftyreports:
+        drug = []
+        for w in v.find('patient').findall('drug'):
+            d = w.find('activesubstance')
+            if d is not None:
+                drug += d[0].text.split("\\")
+        drugs.append(";".join(list(set(drug))).lower())
+    qualifications = []
+    for v in saftyreports:
+        c = v.find('primarysource').find('qualification')
+        qualifications.append('' if c is None else xl.QUALIFICATION[int(c.text)-1])
+    return pd.DataFrame({
+        'Case ID':caseID, 'Active Substances':drugs, 'Reactions':reactions, 'Sex':sex,
+        'Event Date':event_date, 'Event Country':event_country, 'Patient Age':age,
+        'Qualification':qualifications,
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the safetyreport field extraction')
+    parser.add_argument('--n', type=int, default=100000, help='the number of reports')
+    parser.add_argument('--repeat', type=int, default=5, help='the best of this number of runs is shown')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        url = os.path.join(tmp, "synthetic.xml")
+        make_xml(url, args.n)
+        reports = [v for v in ET.parse(url).getroot() if v.tag == "safetyreport"]
+    gc.collect()
+    gc.freeze() # the DOM is not traversed by the garbage collector during the runs
+    fxns = {"eight-pass":eight_pass, "single-pass":xl.Loader2014Q3_()._parse_reports}
+    best = {k:float("inf") for k in fxns}
+    res = dict()
+    for _ in range(args.repeat):
+        for k, fxn in fxns.items():
+            start = time.perf_counter()
+            res[k] = fxn(reports)
+            best[k] = min(best[k], time.perf_counter() - start)
+    print(f"{len(reports)} reports, best of {args.repeat}")
+    for k, v in best.items():
+        print(f"{k:>12}: {v:.3f} s, {v / len(reports) * 1e6:.2f} us/report")
+    print("identical:", res["eight-pass"].equals(res["single-pass"][res["eight-pass"].columns]))
+
+
+if __name__ == "__main__":
+    main()
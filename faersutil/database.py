@@ -25,8 +25,11 @@ import gc
 from tqdm.auto import trange, tqdm
 
 # original packages in src
+from .src import calculator as ca
 from .src import chem_editor as ce
 from .src import db_handler as dh
+from .src import io_handler as ih
+from .src import manifest as ms
 
 ### setup ###
 SEP = os.sep
@@ -38,6 +41,26 @@ parser.add_argument(
     type=str,
     help='working directory that contains outputs of preprocess such as cleansed FAERS data'
     )
+parser.add_argument(
+    '-f', '--format', type=str, default='tsv', choices=ih.FORMAT,
+    help='format of the drug-rxn files, parquet requires pyarrow'
+    )
+parser.add_argument(
+    '-i', '--incremental', action='store_true',
+    help='whether only new or changed stored_years recorded in the manifest are processed'
+    )
+parser.add_argument(
+    '-e', '--engine', type=str, default='vector', choices=['vector', 'loop'],
+    help='engine for expanding records into drug-rxn relations'
+    )
+parser.add_argument(
+    '--chunksize', type=int, default=100000,
+    help='the number of records inserted at once in the bulk load'
+    )
+parser.add_argument(
+    '--no_bulk', action='store_true',
+    help='whether the database is built by DataFrame.to_sql with a connection per table'
+    )
 args = parser.parse_args()
 
 ### main ###
@@ -64,7 +87,7 @@ def update_drugdict():
     """
     print("prepare data", end="...")
     now = datetime.datetime.now().strftime('%Y%m%d')
-    path_faers = glob.glob(args.workdir + SEP + "clean" + SEP + "clean_*.txt")
+    path_faers = ih.glob_table(args.workdir + SEP + "clean" + SEP + "clean_*")
     outdir = args.workdir + SEP + "curated"
     path_ohdsi = glob.glob(outdir + SEP + "Drug_dict_*.txt")
     path_ohdsi = [v for v in path_ohdsi if "Drug_dict_updated" not in v]
@@ -81,7 +104,7 @@ def update_drugdict():
     base_dic = dict(zip(list(ohdsi["key"]), list(ohdsi["value"])))
     rep = list(ohdsi[ohdsi["representative"]==1]["key"])
     # load FAERS data
-    faers = pd.read_csv(path_faers, sep="\t", index_col=0)
+    faers = ih.read_table(path_faers, "clean", columns=["active_substances"])
     faers = faers["active_substances"].map(lambda x: set(x.split("///")))
     faers = set(itertools.chain.from_iterable(faers.values.tolist()))
     # note: chain is much faster than loop
@@ -141,7 +164,7 @@ def prep_drug_rxn():
     for c in rxns.columns:
         rxns.loc[:, c] = rxns.loc[:, c].map(lambda x: x.lower())
     ## prep rxn_id that corresponds to pt
-    pt = list(set(list(rxns["PT"])))
+    pt = sorted(set(list(rxns["PT"]))) # sorted to keep rxn_id stable between runs
     dic_rxn = dict(zip(pt, list(range(len(pt)))))
     rxns.loc[:, "rxn_id"] = [dic_rxn[i] for i in list(rxns["PT"])]
     rxns.loc[:, "unique_rxn_id"] = list(range(rxns.shape[0]))
@@ -160,17 +183,32 @@ def prep_drug_rxn():
     print("DONE")
     # load FAERS data
     print("prepare FAERS data", end="...")
-    path_faers = glob.glob(args.workdir + SEP + "clean" + SEP + "clean_*.txt")
+    path_faers = ih.glob_table(args.workdir + SEP + "clean" + SEP + "clean_*")
     if len(path_faers)==0:
         raise ValueError("!! No clean FAERS data: use 'preprocess' before this !!")
     else:
         path_faers = sorted(path_faers, reverse=True)[0]
-    faers = pd.read_csv(path_faers, sep="\t", index_col=0)[
-        ["case_id", "active_substances", "reactions", "stored_year"]
-        ]
+    col = ["case_id", "active_substances", "reactions", "stored_year"]
+    pushdown = ih.get_format(path_faers) == "parquet"
+    if pushdown:
+        # load each stored_year later
+        faers = ih.read_table(path_faers, "clean", columns=["stored_year"])
+    else:
+        faers = ih.read_table(path_faers, "clean", columns=col)
     print("DONE")
     # convert and expand records
     stored_year = list(set(list(faers["stored_year"])))
+    if args.incremental:
+        mani = ms.Manifest(args.workdir + SEP + "manifest.txt")
+        # rxn_id depends on all the PTs, while only the drug names of each stored_year matter
+        h_rxn = ms.frame_hash(rxns)
+        # outputs of the stored_years that no longer exist
+        for k in mani.get_keys("drug_rxn"):
+            if float(k) not in stored_year:
+                old = mani.get_output("drug_rxn", k)
+                if os.path.exists(old):
+                    os.remove(old)
+                mani.remove("drug_rxn", k)
     print("convert and expand records")
     record0 = 0
     record1 = 0
@@ -178,27 +216,42 @@ def prep_drug_rxn():
     relation1 = 0
     for s in stored_year:
         print(s)
-        arrays = faers[faers["stored_year"]==s].values
-        record0 += arrays.shape[0] # num records before NaN treatment
-        drug_rxn = []
-        ids = []
-        for i in trange(arrays.shape[0]):
-            cid = arrays[i, 0] # case_id
-            drugs = arrays[i, 1].split("///") # active_substances
-            rxns = arrays[i, 2].split("///") # reactions
-            drugs = [dic_drug.get(k, np.nan) for k in drugs]
-            rxns = [dic_rxn.get(k, np.nan) for k in rxns]
-            drug_rxn += list(itertools.product(drugs, rxns)) # cartesian product
-            ids += [cid] * len(drugs) * len(rxns)
-        df_tmp = pd.DataFrame(drug_rxn, columns=["active_substances", "reactions"])
-        df_tmp.loc[:, "case_id"] = ids
-        relation0 += df_tmp.shape[0] # num relation before NaN treatment
-        df_tmp = df_tmp.dropna() # delete not found keys
+        if pushdown:
+            sub = ih.read_table(
+                path_faers, "clean", columns=col, filters=[("stored_year", "==", s)]
+                )
+        else:
+            sub = faers[faers["stored_year"]==s]
+        record0 += sub.shape[0] # num records before NaN treatment
+        if args.incremental:
+            names = set(_explode(sub["active_substances"].values)[0])
+            used = ohdsi.loc[ohdsi["key"].isin(names), ["key", "value"]].sort_values("key", kind="stable")
+            h = ms.concat_hash([h_rxn, ms.frame_hash(used), ms.frame_hash(sub)])
+            if mani.check("drug_rxn", str(s), h):
+                # reuse the previous output
+                old = ih.read_table(mani.get_output("drug_rxn", str(s)), "drug_rxn")
+                relation0 += _count_relation(sub)
+                record1 += old["case_id"].nunique()
+                relation1 += old.shape[0]
+                print("> skipped (already processed)")
+                continue
+        if args.engine == "loop":
+            df_tmp, n = _expand_loop(sub, dic_drug, dic_rxn)
+        else:
+            df_tmp, n = _expand_vector(sub, dic_drug, dic_rxn)
+        relation0 += n # num relation before NaN treatment
         record1 += df_tmp["case_id"].nunique()
         relation1 += df_tmp.shape[0] # num relation after NaN treatment
         df_tmp.loc[:, "stored_year"] = s
         df_tmp = df_tmp.reset_index(drop=True)
-        df_tmp.to_csv(outdir + SEP + f"drug_rxn_{s}_{now}.txt", sep="\t")
+        fileout = outdir + SEP + f"drug_rxn_{s}_{now}{ih.EXT[args.format]}"
+        ih.write_table(df_tmp, fileout, "drug_rxn", args.format)
+        if args.incremental:
+            # the previous output of the stored_year is replaced
+            old = mani.get_output("drug_rxn", str(s))
+            if (old is not None) and (old != fileout) and os.path.exists(old):
+                os.remove(old)
+            mani.update("drug_rxn", str(s), h, fileout)
     summary = pd.DataFrame(
         {"count":[record0, record1, relation0, relation1]},
         index=["n_record_before", "n_record_after", "n_relation_before", "n_relation_after"]
@@ -207,17 +260,140 @@ def prep_drug_rxn():
     print("> completed")
 
 
+def _expand_loop(sub:pd.DataFrame, dic_drug:dict, dic_rxn:dict):
+    """
+    expand records into drug-rxn relations record by record
+
+    Returns
+    -------
+    the relations whose keys are found in the dicts, and the number of relations before that
+
+    """
+    arrays = sub[["case_id", "active_substances", "reactions"]].values
+    drug_rxn = []
+    ids = []
+    for i in trange(arrays.shape[0]):
+        cid = arrays[i, 0] # case_id
+        drugs = arrays[i, 1].split("///") # active_substances
+        rxns = arrays[i, 2].split("///") # reactions
+        drugs = [dic_drug.get(k, np.nan) for k in drugs]
+        rxns = [dic_rxn.get(k, np.nan) for k in rxns]
+        drug_rxn += list(itertools.product(drugs, rxns)) # cartesian product
+        ids += [cid] * len(drugs) * len(rxns)
+    df_tmp = pd.DataFrame(drug_rxn, columns=["active_substances", "reactions"])
+    df_tmp.loc[:, "case_id"] = ids
+    n = df_tmp.shape[0]
+    df_tmp = df_tmp.dropna() # delete not found keys
+    return df_tmp, n
+
+
+def _expand_vector(sub:pd.DataFrame, dic_drug:dict, dic_rxn:dict):
+    """
+    expand records into drug-rxn relations with one split over the whole column
+    and a cross join per record built with numpy
+    the rows and their order are the same as _expand_loop
+
+    Returns
+    -------
+    the relations whose keys are found in the dicts, and the number of relations before that
+
+    """
+    n_rec = sub.shape[0]
+    col = ["active_substances", "reactions", "case_id"]
+    if n_rec == 0:
+        return pd.DataFrame(columns=col), 0
+    case_id = sub["case_id"].values
+    # explode, d_rec and r_rec indicate the position of the record
+    drug, nd = _explode(sub["active_substances"].values)
+    rxn, nr = _explode(sub["reactions"].values)
+    n = int(np.dot(nd, nr))
+    d_rec = np.repeat(np.arange(n_rec), nd)
+    r_rec = np.repeat(np.arange(n_rec), nr)
+    # encode and delete not found keys
+    drug = pd.Series(drug).map(dic_drug).values.astype(float)
+    rxn = pd.Series(rxn).map(dic_rxn).values.astype(float)
+    drug_found = ~np.isnan(drug)
+    rxn_found = ~np.isnan(rxn)
+    drug, d_rec = drug[drug_found], d_rec[drug_found]
+    rxn, r_rec = rxn[rxn_found], r_rec[rxn_found]
+    # cross join per record, drug-major as itertools.product
+    nr = np.bincount(r_rec, minlength=n_rec)
+    r_start = np.cumsum(nr) - nr
+    rep = nr[d_rec] # the number of rxns paired with each drug
+    total = int(rep.sum())
+    e_start = np.cumsum(rep) - rep
+    idx = np.arange(total) - np.repeat(e_start, rep) + np.repeat(r_start[d_rec], rep)
+    df_tmp = pd.DataFrame({
+        "active_substances":np.repeat(drug, rep),
+        "reactions":rxn[idx],
+        "case_id":np.repeat(case_id[d_rec], rep),
+        })
+    # keep dtypes of _expand_loop, float if any key is not found
+    if drug_found.all():
+        df_tmp["active_substances"] = df_tmp["active_substances"].astype(np.int64)
+    if rxn_found.all():
+        df_tmp["reactions"] = df_tmp["reactions"].astype(np.int64)
+    return df_tmp, n
+
+
+def _explode(values, sep:str="///"):
+    """ split the concatenated names into a flat list and the number of names of each record """
+    flat = sep.join(values).split(sep)
+    n = np.array([v.count(sep) for v in values], dtype=np.int64) + 1
+    return flat, n
+
+
+def _count_relation(df:pd.DataFrame):
+    """ the number of drug-rxn relations before conversion """
+    n_drug = df["active_substances"].str.count("///") + 1
+    n_rxn = df["reactions"].str.count("///") + 1
+    return int((n_drug * n_rxn).sum())
+
+
 def make_database():
     """
     generate database from FAERS clean data
+    in the incremental mode, the existing database recorded in the manifest is updated:
+    - tables from curated files are replaced only if the files have changed
+    - case_table and drug_rxn_table are updated by each new or changed stored_year
     
     """
     # init
     start = time.time()
     now = datetime.datetime.now().strftime('%Y%m%d')
     fileout = args.workdir + SEP + f"sqlite_{now}.db"
+    mani = None
+    if args.incremental:
+        mani = ms.Manifest(args.workdir + SEP + "manifest.txt")
+        prev = [mani.get_output("database", k) for k in mani.get_keys("database")]
+        prev = [v for v in prev if os.path.exists(v)]
+        if len(prev) > 0:
+            fileout = sorted(prev)[-1] # append to the existing database
     dat = dh.DBhandler()
     dat.set_path(fileout)
+    if args.no_bulk:
+        _build_database(dat, mani)
+        dat.create_indexes()
+    else:
+        with dat.bulk_load(chunksize=args.chunksize):
+            _build_database(dat, mani) # indexes are built at the end for a new database
+    dat.analyze()
+    # query plan
+    with ca.Calculator(dat.path) as calc:
+        plan = calc.check_plan()
+    print(plan)
+    if not plan["index_used"].all():
+        print("CAUTION: some queries of Calculator do not use the indexes of drug_rxn_table")
+    # summary
+    print("> completed")
+    elapsed = time.time() - start
+    h, rem = divmod(elapsed, 3600)
+    m, s = divmod(rem, 60)
+    print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+
+
+def _build_database(dat, mani=None):
+    """ build the tables of the database """
     # qualification table
     print("prepare qualification table")
     tmp_filein = glob.glob(args.workdir + SEP + "clean" + SEP + "qualification_*.txt")
@@ -227,7 +403,7 @@ def make_database():
         tmp_filein = sorted(tmp_filein, reverse=True)[0]
     dtypes = {"qual_id":int, "qual_name":str}
     df = pd.read_csv(tmp_filein, sep="\t", index_col=0, dtype=dtypes)
-    dat.make_qualification_table(df)
+    _make_table(dat, "qualification_table", dat.make_qualification_table, df, tmp_filein, mani)
     del df
     gc.collect()
     print("> DONE")
@@ -240,7 +416,7 @@ def make_database():
         tmp_filein = sorted(tmp_filein, reverse=True)[0]
     dtypes = {"rxn_id":int}
     df = pd.read_csv(tmp_filein, sep="\t", index_col=0)
-    dat.make_rxn_table(df)
+    _make_table(dat, "rxn_table", dat.make_rxn_table, df, tmp_filein, mani)
     del df
     gc.collect()
     print("> DONE")
@@ -257,7 +433,7 @@ def make_database():
         "TPSA":float, "XLogP":float, "category":int,
         }
     df = pd.read_csv(tmp_filein, sep="\t", index_col=0, dtype=dtypes)
-    dat.make_drug_table(df)
+    _make_table(dat, "drug_table", dat.make_drug_table, df, tmp_filein, mani)
     del df
     gc.collect()
     print("> DONE")
@@ -272,14 +448,14 @@ def make_database():
         "drug_dict_id":int, "key":str, "value":int, "representative":int,
         }
     df = pd.read_csv(tmp_filein, sep="\t", index_col=0, dtype=dtypes)
-    dat.make_drug_dict(df)
+    _make_table(dat, "drug_dict", dat.make_drug_dict, df, tmp_filein, mani)
     del df
     gc.collect()
     print("> DONE")
     # case table
     print("prepare case table")
     print("<< time-consuming step >>")
-    tmp_filein = glob.glob(args.workdir + SEP + "clean" + SEP + "clean_*.txt")
+    tmp_filein = ih.glob_table(args.workdir + SEP + "clean" + SEP + "clean_*")
     if len(tmp_filein)==0:
         raise ValueError("!! No clean FAERS data: use 'preprocess' before this !!")
     else:
@@ -289,37 +465,120 @@ def make_database():
         "event_date":int, "event_country":str, "patient_age":int, 
         "qualification":int, "stored_year":float
         }
-    df = pd.read_csv(tmp_filein, sep="\t", index_col=0, dtype=dtypes)
-    dat.make_case_table(df)
+    col = [
+        "case_id", "sex", "event_date", "event_country",
+        "patient_age", "qualification", "stored_year"
+        ] # drugs and reactions are not necessary
+    df = ih.read_table(tmp_filein, "clean", columns=col, dtype=dtypes)
+    path_drug_rxn = ih.glob_table(args.workdir + SEP + "drug_rxn" + SEP + "drug_rxn_*")
+    if len(path_drug_rxn)==0:
+        raise ValueError("!! No updated drug-rxn relationship: use 'preprocess' before this !!")
+    else:
+        path_drug_rxn = sorted(path_drug_rxn, reverse=False)
+    pending = dict()
+    if mani is not None:
+        # narrow to the new or changed stored_years
+        df, path_drug_rxn, pending = _update_year(dat, mani, df, path_drug_rxn)
+    if not dat._check_table("case_table"):
+        dat.make_case_table(df)
+    elif df.shape[0] > 0:
+        dat.make_case_table(df, if_exists="append")
     del df
     gc.collect()
     print("> DONE")
     # drug_rxn_table
     print("prepare drug-rxn table")
     print("<< time-consuming step >>")
-    tmp_filein = glob.glob(args.workdir + SEP + "drug_rxn" + SEP + "drug_rxn_*.txt")
-    if len(tmp_filein)==0:
-        raise ValueError("!! No updated drug-rxn relationship: use 'preprocess' before this !!")
-    else:
-        tmp_filein = sorted(tmp_filein, reverse=False)
+    tmp_filein = path_drug_rxn
     dtypes = {
         "drug_rxn_id":int, "case_id":int, "drug_id":int, "rxn_id":int,
         }
     for t in tqdm(tmp_filein):
-        df = pd.read_csv(t, sep="\t", index_col=0, dtype=dtypes)
+        df = ih.read_table(t, "drug_rxn", dtype=dtypes)
         dat.make_drug_rxn_table(df, if_exists="append")
         del df
         gc.collect()
     # logging
-    dat._to_history(target_table="drug_rxn_table", description="newly create")
+    if mani is None:
+        dat._to_history(target_table="drug_rxn_table", description="newly create")
+    else:
+        dat._to_history(target_table="drug_rxn_table", description=f"append {len(tmp_filein)} files")
+        for k, h in pending.items():
+            mani.update("database", k, h, dat.path, save=False)
+        mani.save()
     dat.head("drug_rxn_table")
     print("> DONE")
-    # summary
-    print("> completed")
-    elapsed = time.time() - start
-    h, rem = divmod(elapsed, 3600)
-    m, s = divmod(rem, 60)
-    print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+
+
+def _make_table(dat, name:str, fxn, df:pd.DataFrame, filein:str, mani=None):
+    """
+    make a table with the indicated method of DBhandler
+    in the incremental mode, the table is replaced only if the input file has changed
+
+    """
+    if mani is None:
+        fxn(df)
+        return
+    h = ms.file_hash(filein)
+    exist = dat._check_table(name)
+    if exist & mani.check("database", name, h) & (mani.get_output("database", name) == dat.path):
+        print("> skipped (not changed)")
+        return
+    if exist:
+        dat.delete_records(name)
+        fxn(df, if_exists="append")
+    else:
+        fxn(df)
+    mani.update("database", name, h, dat.path)
+
+
+def _update_year(dat, mani, df:pd.DataFrame, path_drug_rxn:list):
+    """
+    narrow the case table and the drug_rxn files to the new or changed stored_years
+    the records of the changed or removed stored_years are deleted from the database
+
+    Returns
+    -------
+    the narrowed case table, the narrowed drug_rxn files,
+    and the hashes of the stored_years to be recorded after loading
+
+    """
+    dic_path = dict() # stored_year: drug_rxn file
+    for p in path_drug_rxn:
+        dic_path[float(os.path.basename(p).split("_")[2])] = p
+    stored_year = sorted(set(list(df["stored_year"])))
+    changed = []
+    pending = dict()
+    for s in stored_year:
+        k = f"stored_year={s}"
+        h = [ms.frame_hash(df[df["stored_year"]==s])]
+        if s in dic_path:
+            h.append(ms.file_hash(dic_path[s]))
+        h = ms.concat_hash(h)
+        if mani.check("database", k, h) & (mani.get_output("database", k) == dat.path):
+            continue
+        changed.append(s)
+        pending[k] = h
+    removed = []
+    for k in mani.get_keys("database"):
+        if k.startswith("stored_year=") and (float(k.split("=")[1]) not in stored_year):
+            removed.append(float(k.split("=")[1]))
+            mani.remove("database", k, save=False)
+    print(f"> {len(changed)} stored_years are new or changed: {changed}")
+    # delete the previous records
+    target = changed + removed
+    if (len(target) > 0) & dat._check_table("case_table"):
+        txt = ", ".join([str(v) for v in target])
+        if dat._check_table("drug_rxn_table"):
+            dat.delete_records(
+                "drug_rxn_table",
+                f"case_id IN (SELECT case_id FROM case_table WHERE stored_year IN ({txt}))"
+                )
+        dat.delete_records("case_table", f"stored_year IN ({txt})")
+    df = df[df["stored_year"].isin(changed)]
+    path_drug_rxn = [dic_path[s] for s in changed if s in dic_path]
+    return df, path_drug_rxn, pending
+
 
 if __name__ == '__main__':
     main()     
@@ -41,11 +41,14 @@ import argparse
 import numpy as np
 import pandas as pd
 import glob
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from tqdm.auto import trange, tqdm
 
 # original packages in src
 from .src import xml_loader as xm
+from .src import io_handler as ih
+from .src import manifest as ms
 from .src import cleanser as cl
 from .src import ohdsi_handler as oh
 from .src import synodict as sd
@@ -72,6 +75,30 @@ parser.add_argument(
     '-d', '--drug_only', action='store_true',
     help='whether drug curation only or not'
     )
+parser.add_argument(
+    '-s', '--stream', action='store_true',
+    help='whether xml files are parsed in the stream mode (iterparse) to keep memory flat'
+    )
+parser.add_argument(
+    '-w', '--workers', type=int, default=1,
+    help='the number of processes for parsing xml files'
+    )
+parser.add_argument(
+    '--max_large', type=int, default=2,
+    help='the maximum number of large xml files parsed concurrently'
+    )
+parser.add_argument(
+    '--large_size', type=float, default=500,
+    help='file size (MB) over which an xml file is regarded as large'
+    )
+parser.add_argument(
+    '-f', '--format', type=str, default='tsv', choices=ih.FORMAT,
+    help='format of the parsed and clean files, parquet requires pyarrow'
+    )
+parser.add_argument(
+    '-i', '--incremental', action='store_true',
+    help='whether only new or changed inputs recorded in the manifest are processed'
+    )
 args = parser.parse_args()
 
 ### main ###
@@ -119,11 +146,12 @@ def parse_xml():
     Returns
     -------
     The parsed tsv files named like parsed_2014q3_1.txt
+    (or parsed_2014q3_1.parquet with --format parquet)
     These will be packed into parsed directory
     
     """
     # url setting
-    path_list = glob.glob(args.workdir + SEP + "faers_xml*")
+    path_list = sorted(glob.glob(args.workdir + SEP + "faers_xml*"))
     keys = []
     ## both q and Q exist to indicate quarter
     for p in path_list:
@@ -132,36 +160,99 @@ def parse_xml():
     outdir = args.workdir + SEP + "parsed"
     if not os.path.exists(outdir):
         os.makedirs(outdir)
-    # parse
-    for p_dir, key in tqdm(zip(path_list, keys)):
-        path_xmls = glob.glob(p_dir + f"{SEP}xml{SEP}*.xml")
+    # prepare jobs, (path, fileout)
+    ## xml files are sorted to keep the index i of parsed_{key}_{i} deterministic
+    ext = ih.EXT[args.format]
+    jobs = []
+    for p_dir, key in zip(path_list, keys):
+        path_xmls = sorted(glob.glob(p_dir + f"{SEP}xml{SEP}*.xml"))
         if len(path_xmls)==0:
             # 2020~
-            path_xmls = glob.glob(p_dir + f"{SEP}XML{SEP}*.xml")
+            path_xmls = sorted(glob.glob(p_dir + f"{SEP}XML{SEP}*.xml"))
         if key > 2014.2:
             # from 2014Q3
+            key = str(key).replace(".", "q")
             for i, path in enumerate(path_xmls):
-                dat = xm.Loader2014Q3_()
-                key = str(key).replace(".", "q")
-                fileout = outdir + SEP + f"parsed_{key}_{i}.txt"
-                try:
-                    df = dat.load_xml(path, fileout=fileout, to_csv=True, sep="\t")
-                except Exception as e:
-                    print(f"!! An Error Ocurred: {e} !!")
-                    print(path)
+                jobs.append((path, outdir + SEP + f"parsed_{key}_{i}{ext}"))
         else:
             pass
             # note: skip before 2014Q3 since the current program became inappropriate
-            # from 2012Q4 to 2014Q2
-            # for i, path in enumerate(path_xmls):
-            #     dat = xm.Loader2012Q4_2014Q2()
-            #     key = str(key).replace(".", "q")
-            #     fileout = outdir + SEP + f"parsed_{key}_{i}.txt"
-            #     try:
-            #         df = dat.load_xml(path, fileout=fileout, to_csv=True, sep="\t")
-            #     except Exception as e:
-            #         print(f"!! An Error Ocurred: {e} !!")
-            #         print(path)
+            # from 2012Q4 to 2014Q2, use xm.Loader2012Q4_2014Q2 instead
+    # skip the files already parsed
+    if args.incremental:
+        mani = ms.Manifest(args.workdir + SEP + "manifest.txt")
+        hashes = dict()
+        rest = []
+        for path, fileout in jobs:
+            h = ms.file_hash(path)
+            if mani.check("parse", path, h) & (mani.get_output("parse", path) == fileout):
+                continue
+            hashes[path] = h
+            rest.append((path, fileout))
+        print(f"> {len(jobs) - len(rest)} files are skipped (already parsed)")
+        jobs = rest
+    # parse
+    if args.workers > 1:
+        results = _parse_parallel(jobs)
+    else:
+        results = [
+            xm.parse_file(path, fileout, stream=args.stream, fmt=args.format)
+            for path, fileout in tqdm(jobs)
+            ]
+    if args.incremental:
+        outputs = dict(jobs)
+        for path, e in results:
+            if e is None:
+                mani.update("parse", path, hashes[path], outputs[path], save=False)
+        mani.save()
+    # summary
+    errors = [v for v in results if v[1] is not None]
+    print(f"> parsed {len(jobs) - len(errors)} / {len(jobs)} files")
+    summary = pd.DataFrame(errors, columns=["path", "error"])
+    if len(errors) > 0:
+        now = datetime.datetime.now().strftime('%Y%m%d')
+        summary.to_csv(args.workdir + SEP + f"parse_error_{now}.txt", sep="\t")
+        print(f"!! {len(errors)} files failed !!")
+        print(summary)
+
+
+def _parse_parallel(jobs:list):
+    """
+    parse xml files with a process pool
+    the number of large files parsed at once is limited by max_large to bound peak memory
+
+    """
+    large = args.large_size * 1024**2
+    max_large = max(args.max_large, 1)
+    pending = [(path, fileout, os.path.getsize(path) > large) for path, fileout in jobs]
+    running = dict() # future: (path, whether large or not)
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor, tqdm(total=len(jobs)) as pbar:
+        while (len(pending) > 0) | (len(running) > 0):
+            # submit jobs up to the number of workers
+            n_large = sum(v[1] for v in running.values())
+            rest = []
+            for path, fileout, is_large in pending:
+                if (len(running) < args.workers) & ((not is_large) | (n_large < max_large)):
+                    future = executor.submit(
+                        xm.parse_file, path, fileout, args.stream, "\t", args.format
+                        )
+                    running[future] = (path, is_large)
+                    n_large += is_large
+                else:
+                    rest.append((path, fileout, is_large))
+            pending = rest
+            # collect
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                path, _ = running.pop(future)
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # e.g. the worker was killed
+                    results.append((path, f"{type(e).__name__}: {e}"))
+                pbar.update(1)
+    return results
 
 # def parse_sgml():
 #     """
@@ -201,34 +292,43 @@ def clean_and_merge():
     Returns
     -------
     - tsv, a cleaned and combined tsv file named like clean_20230830.txt
+        (or clean_20230830.parquet with --format parquet)
     - tsv, a table for qualificaion encoding
     
     """
     # init
-    path_list = glob.glob(args.workdir + SEP + "parsed" + SEP + "*.txt")
+    path_list = ih.glob_table(args.workdir + SEP + "parsed" + SEP + "parsed_*")
+    path_list = sorted(path_list) # keep-first of duplicated case_id should not depend on glob
     now = datetime.datetime.now().strftime('%Y%m%d')
     outdir = args.workdir + SEP + "clean"
     if not os.path.exists(outdir):
         os.makedirs(outdir)
-    fileout = outdir + SEP + f"clean_{now}.txt"
+    fileout = outdir + SEP + f"clean_{now}{ih.EXT[args.format]}"
+    if args.incremental:
+        # cleaned parts of each parsed file are kept to be reused
+        mani = ms.Manifest(args.workdir + SEP + "manifest.txt")
+        partdir = args.workdir + SEP + "clean_part"
+        if not os.path.exists(partdir):
+            os.makedirs(partdir)
     results = []
+    n_skip = 0
     for path in tqdm(path_list):
-        fname = path.split("parsed_")[-1]
-        key = fname.split("_")[0].replace("q", ".")
-        df = pd.read_csv(path, sep="\t").dropna(subset=["Active Substances"]) # Some records miss it
-        dat = cl.Cleanser()
-        dat.set_data(data=df)
-        dat.data_cleansing()
-        # dat.set_exception()
-        # dat.exclude_exception()
-        # 230803 skip exception handling in this phase, which will be done in the integration phase
-        res = dat.get_data()
-        res.loc[:, "Stored Year"] = [float(key)] * res.shape[0] # add store date
+        if args.incremental:
+            h = ms.file_hash(path)
+            if mani.check("clean", path, h):
+                results.append(pd.read_pickle(mani.get_output("clean", path)))
+                n_skip += 1
+                continue
+        res = _clean_file(path)
+        if args.incremental:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            part = partdir + SEP + f"{stem}.pkl"
+            res.to_pickle(part)
+            mani.update("clean", path, h, part)
         results.append(res)
+    if args.incremental:
+        print(f"> {n_skip} files are skipped (already cleaned)")
     results = pd.concat(results, axis=0, join="inner")
-    # set to str
-    results.loc[:,"Active Substances"] = results.loc[:,"Active Substances"].map(list).apply(_concat)
-    results.loc[:,"Reactions"] = results.loc[:,"Reactions"].map(list).apply(_concat)
     # encode qualification
     dic = {
         "N":0, "Consumer or non-health proffesional":1, "Lawyer":2,
@@ -246,7 +346,26 @@ def clean_and_merge():
     # export
     col = [v.replace(" ", "_").lower() for v in list(results.columns)] # to lower
     results.columns = col
-    results.to_csv(fileout, sep="\t")
+    ih.write_table(results, fileout, "clean", args.format)
+
+
+def _clean_file(path:str):
+    """ cleansing a parsed file """
+    fname = path.split("parsed_")[-1]
+    key = fname.split("_")[0].replace("q", ".")
+    df = ih.read_table(path, "parsed").dropna(subset=["Active Substances"]) # Some records miss it
+    dat = cl.Cleanser()
+    dat.set_data(data=df)
+    dat.data_cleansing()
+    # dat.set_exception()
+    # dat.exclude_exception()
+    # 230803 skip exception handling in this phase, which will be done in the integration phase
+    res = dat.get_data()
+    res.loc[:, "Stored Year"] = [float(key)] * res.shape[0] # add store date
+    # set to str
+    res.loc[:,"Active Substances"] = res.loc[:,"Active Substances"].map(list).apply(_concat)
+    res.loc[:,"Reactions"] = res.loc[:,"Reactions"].map(list).apply(_concat)
+    return res
 
 
 def _concat(lst:list, gap:str="///"):
@@ -10,15 +10,42 @@ FAERSUtil o-- Calculator
 import pandas as pd
 import numpy as np
 import sqlite3
-from contextlib import closing
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from contextlib import nullcontext, closing
+from operator import itemgetter
 from tqdm.auto import tqdm
 import time
-from scipy import stats
+from scipy import stats, sparse
 import statsmodels.stats.multitest as multitest
 from tqdm import tqdm
-import math
 import time
 
+from .signal_metrics import SignalMetrics
+from .result_cache import ResultCache
+from .id_set import IDSet
+from .interaction import Interaction
+from .meddra import MedDRAIndex
+
+# strata of make_strat_table, fields of case_table and event_quarter derived from event_date
+STRATA = ["sex", "patient_age", "event_country", "qualification", "stored_year", "event_quarter"]
+
+# quarter of event_date given as YYYYMMDD or YYYYMM like stored_year (e.g. 2015.1)
+# NULL if unknown, such as YYYY only or the month out of 1-12 (e.g. 20150000)
+QUARTER = (
+    "CASE WHEN c.event_date >= 10000000 AND c.event_date / 100 % 100 BETWEEN 1 AND 12 THEN "
+    "ROUND(c.event_date / 10000 + ((c.event_date / 100 % 100 - 1) / 3 + 1) / 10.0, 1) "
+    "WHEN c.event_date BETWEEN 100000 AND 9999999 AND c.event_date % 100 BETWEEN 1 AND 12 THEN "
+    "ROUND(c.event_date / 100 + ((c.event_date % 100 - 1) / 3 + 1) / 10.0, 1) "
+    "ELSE NULL END"
+    )
+
+# 'in' sets larger than this are given as temp tables
+# SQLITE_MAX_VARIABLE_NUMBER is 999 before SQLite 3.32 and a query has up to three 'in' sets
+MAX_PARAMS = 250
+
 class Calculator:
     """
     calculate FAERS statistics
@@ -33,84 +60,623 @@ class Calculator:
     sum                           np1                np2             npp
 
     """
-    def __init__(self, db_path:str):
+    def __init__(
+        self, db_path:str, cache_dir:str=None, cache_mb:float=1024,
+        n_jobs:int=1, immutable:bool=False, wal:bool=False,
+        ):
+        """
+        Parameters
+        ----------
+        db_path: str
+            path of the sqlite database
+
+        cache_dir: str
+            directory of the on-disk cache of make_table results, no cache if None
+
+        cache_mb: float
+            the size limit of the cache in MB, least recently used entries are evicted
+
+        n_jobs: int
+            number of the threads counting the drugs of make_table, each with its own read-only connection
+            each connection loads its own copy of the temp tables of the large ID sets such as case_id,
+            about 8 MB per million IDs for each thread
+
+        immutable: bool
+            whether the database is opened as immutable, without any locking nor change detection
+            the file must not be modified while the calculator is open
+
+        wal: bool
+            whether the database file is switched to WAL mode at the first parallel query,
+            so that the readers and a writer do not block each other
+            the mode is persistent in the file, note that it changes the file of the user
+
+        """
         self.db_path = db_path
-        self.tmake = Cond2Text()
+        self.n_jobs = max(int(n_jobs), 1)
+        self.immutable = immutable
+        self.wal = wal
+        self._conn = None # long-lived read-only connection, see open()
+        self._pragma = (1024, 256) # mmap and cache in MB of the connections
+        self._temp_keys = dict() # {connection: {temp table name: key of the loaded values}}
+        self._pool = None # thread pool of the parallel queries, see _fetch_many()
+        self._local = threading.local() # connection of each thread of the pool
+        self._pool_conns = []
+        self._lock = threading.Lock()
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ResultCache(cache_dir, cache_mb)
+        self.tmake = Cond2Text(filter_keys=("case_id",))
         self.__stats = CommonFxn()
-        self.drug_id = set()
-        self.rxn_id = set()
-        self.case_id = set()
+        self.__metrics = SignalMetrics()
+        self.prior = dict() # prior of MGPS used by the last calc_stat
+        self.drug_id = IDSet()
+        self.rxn_id = IDSet()
+        self.case_id = IDSet()
         self.table = None
+        self.__query = None # drugs, reactions, and margins of the table of make_table, see _check_query
+        self.__decoder = dict() # dimension tables loaded at the first use, see _load_decoder
+
+
+    def open(self, mmap_mb:int=1024, cache_mb:int=256):
+        """
+        open the long-lived read-only connection shared by the queries
+        called implicitly by the first query, and closed by close() or at the end of the with block
+
+        Parameters
+        ----------
+        mmap_mb: int
+            size of the memory-mapped I/O in MB
+
+        cache_mb: int
+            page cache of the connection in MB
+
+        """
+        self.close()
+        self._pragma = (mmap_mb, cache_mb)
+        self._conn = self._new_conn()
+        return self
+
+
+    def close(self):
+        """ close the connection and the thread pool """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        for conn in self._pool_conns:
+            conn.close()
+        self._pool_conns = []
+        self._local = threading.local()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._temp_keys = dict()
+
+
+    def __enter__(self):
+        if self._conn is None:
+            self.open()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __del__(self):
+        if getattr(self, "_pool", None) is not None:
+            self._pool.shutdown(wait=False)
+        for conn in getattr(self, "_pool_conns", []):
+            conn.close()
+        if getattr(self, "_conn", None) is not None:
+            self._conn.close()
 
 
     def make_table(
         self, drug_list:list=[], category:int=1, 
         rxn_list:list=[], layer:str="soc",
-        qualification:int=2,
+        qualification:int=2, engine:str="grouped", use_cache:bool=True,
         ):
         """
         reflect ID preprocessing
 
         Parameters
         ----------
+        rxn_list: list or dict
+            terms in the layer, those ending with '*' are prefixes such as 'cardiac*'
+            {layer: terms} selects the terms of several layers at once
+
+        engine: str
+            how to count n11 and n1p of the drugs
+            grouped: one aggregation grouped by drug_id for all the drugs
+            loop: two queries for each drug
+            both are run in parallel by the chunks of the drugs if n_jobs > 1
+
+        use_cache: bool
+            whether the result is loaded from and stored in the cache if any
+            the key is the arguments, the IDs after the preprocessing, and the fingerprint of the database
 
         """
+        if engine not in {"grouped", "loop"}:
+            raise KeyError("!! engine should be chosen from {grouped, loop} !!")
         # 0. init
         start = time.time()
         ## narrow drugs based on category
         self.prep_drug([{"ctype":"ge", "key":"category", "value":category}])
         ## narrow records based on qualification
         self.prep_case([{"ctype":"ge", "key":"qualification", "value":qualification}])
+        key = None
+        if use_cache & (self.cache is not None):
+            # the IDs resolved by the preprocessing, the same for the same calls
+            key = self.cache.make_key(
+                self.db_path, drug_list=drug_list, category=category, rxn_list=rxn_list,
+                layer=layer, qualification=qualification,
+                drug_id=IDSet(self.drug_id).values, rxn_id=IDSet(self.rxn_id).values,
+                case_id=IDSet(self.case_id).values,
+                )
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.__query = cached.get("query")
+                # entries stored without the margins
+                self.__query.setdefault("np1", cached["table"]["np1"].values[0])
+                self.__query.setdefault("npp", cached["table"]["npp"].values[0])
+                self.__query.setdefault("integrated", set())
+                self.table = cached["table"].copy()
+                print("> loaded from cache")
+                return self.table
         ## no pre-selection for reactions
         dic_cond = dict()
-        dic_cond["drug_id"] = {"ctype":"in", "key":"drug_id", "value":tuple(self.drug_id)}
-        dic_cond["case_id"] = {"ctype":"in", "key":"case_id", "value":tuple(self.case_id)}
-        # 1. npp
-        print("count npp...", end="")
+        dic_cond["drug_id"] = {"ctype":"in", "key":"drug_id", "value":self.drug_id}
+        dic_cond["case_id"] = {"ctype":"in", "key":"case_id", "value":self.case_id}
+        # 1. npp, np1, and np2, two independent queries run in parallel if n_jobs > 1
+        print("count npp, np1, and np2...", end="")
         conds = [dic_cond["case_id"], dic_cond["drug_id"]]
-        npp = self._count_any("drug_rxn_table", "case_id", conds, inner_join="AND")
-        print("DONE")
-        # 2. prep rxns
-        print("count np1 and np2...", end="")
-        dic_cond["rxn_id"] = {"ctype":"in", "key":"rxn_id", "value":tuple(self._select_rxn(rxn_list, layer))}
-        conds.append(dic_cond["rxn_id"])
-        np1 = self._count_any("drug_rxn_table", "case_id", conds, inner_join="AND")
+        dic_cond["rxn_id"] = {"ctype":"in", "key":"rxn_id", "value":self._select_rxn(rxn_list, layer)}
+        orders = [
+            self._count_order("drug_rxn_table", "case_id", conds),
+            self._count_order("drug_rxn_table", "case_id", conds + [dic_cond["rxn_id"]]),
+            ]
+        npp, np1 = [v[0][0] for v in self._fetch_many(orders)]
         np2 = npp - np1
-        conds = conds[:-1] # restore for n1p and n2p
         print("DONE")
-        # 3. count n1p and n2p
+        # 2. count n1p and n2p
         print("count drugs...")
         drugs = self._select_drug(drug_list)
         result = dict() # {drug_id: [n11, n12, n1p, n21, n22 n2p, np1, np2, npp]}
         idx = ["n11", "n12", "n1p", "n21", "n22", "n2p", "np1", "np2", "npp"]
+        if engine == "grouped":
+            counts = self._count_grouped(conds, dic_cond["rxn_id"], drugs)
+        else:
+            counts = self._count_loop(conds, dic_cond["rxn_id"], drugs)
         for d in tqdm(drugs):
-            tmp = {"ctype":"equal", "key":"drug_id", "value":d}
-            conds.append(tmp)
-            n1p = self._count_any("drug_rxn_table", "case_id", conds, inner_join="AND")
+            n1p, n11 = counts.get(d, (0, 0))
             n2p = npp - n1p
-            conds.append(dic_cond["rxn_id"]) # drug x rsn
-            n11 = self._count_any("drug_rxn_table", "case_id", conds, inner_join="AND")
             n12 = n1p - n11
             n21 = np1 - n11
             n22 = n2p - n21
             result[d] = [n11, n12, n1p, n21, n22, n2p, np1, np2, npp]
-            conds = conds[:-2] # restore the base
         result = pd.DataFrame(result, index=idx).T
         # summary
-        decoder = dict()
-        for d in drugs:
-            c0 = {"ctype":"equal", "key":"drug_id", "value":d}
-            c1 = {"ctype":"equal", "key":"representative", "value":1}
-            tmp = self._select_any("drug_dict", "drug_name", [c0, c1])
-            assert len(tmp) == 1 # selected result sould be unique
-            decoder[d] = tmp.pop()
+        decoder = self._decode_drug(drugs)
         ids = list(result.index)
         ids = [decoder[c] for c in ids]
         result.index = ids
-        ## ToDo: rxns are also decoded
+        ## the labels of the reactions are given by decode_rxn()
+        self.table = result
+        self.__query = {
+            "drug":{v:k for k, v in decoder.items()}, "rxn_id":dic_cond["rxn_id"]["value"],
+            "np1":np1, "npp":npp, "integrated":set(), # names given by integrate_drug
+            }
+        if key is not None:
+            self.cache.put(key, {"table":result, "query":self.__query})
+        print("> completed")
+        elapsed = time.time() - start
+        h, rem = divmod(elapsed, 3600)
+        m, s = divmod(rem, 60)
+        print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+        return result
+
+
+    def correct_masking(self, masks:list, table=None):
+        """
+        correct the competition bias (masking) by removing the cases with the masking drugs
+        the counts of such cases are subtracted from the table of make_table
+        instead of recounting all the cases
+
+        Parameters
+        ----------
+        masks: list
+            names of the masking drugs
+
+        table: pd.DataFrame
+            the output of the last make_table, whose counts are not yet corrected
+            the drugs merged by integrate_drug are left out
+
+        Returns
+        -------
+        pd.DataFrame of the corrected counts without the masking drugs
+        apply calc_stat for the statistics
+
+        """
+        if table is None:
+            table = self.table
+        query = self._check_query(table)
+        integrated = [v for v in table.index if v in query["integrated"]]
+        if len(integrated) > 0:
+            print(f"CAUTION: the integrated drugs {integrated} are left out")
+            table = table.loc[[v for v in table.index if v not in query["integrated"]]]
+        tmp = [d.lower() for d in masks]
+        mask_id = self._select_ids("drug_dict", "drug_id", [{"ctype":"in", "key":"drug_name", "value":tuple(tmp)}])
+        if len(mask_id) == 0:
+            raise ValueError("!! No drugs were selected: check the given list !!")
+        # counts of the cases with the masking drugs
+        decoder = query["drug"]
+        drugs = IDSet([decoder[d] for d in table.index])
+        npp, np1, counts = self._count_masked(mask_id, query["rxn_id"], drugs)
+        n1p = np.array([counts.get(decoder[d], (0, 0))[0] for d in table.index], dtype=np.int64)
+        n11 = np.array([counts.get(decoder[d], (0, 0))[1] for d in table.index], dtype=np.int64)
+        # subtraction
+        result = table[["n11", "n12", "n1p", "n21", "n22", "n2p", "np1", "np2", "npp"]].copy()
+        result["npp"] -= npp
+        result["np1"] -= np1
+        result["n1p"] -= n1p
+        result["n11"] -= n11
+        result["np2"] = result["npp"] - result["np1"]
+        result["n2p"] = result["npp"] - result["n1p"]
+        result["n12"] = result["n1p"] - result["n11"]
+        result["n21"] = result["np1"] - result["n11"]
+        result["n22"] = result["n2p"] - result["n21"]
+        # the masking drugs themselves are left with no cases
+        result = result[[decoder[d] not in mask_id for d in result.index]]
+        return result
+
+
+    def make_tables(
+        self, rxn_groups:dict, drug_list:list=[], category:int=1,
+        layer:str="soc", qualification:int=2,
+        ):
+        """
+        make the contingency tables of the drugs for each group of reactions at once
+        the drug and case filtering and npp are shared by the groups,
+        and np1 and n11 of all the groups are counted by one aggregation
+
+        Parameters
+        ----------
+        rxn_groups: dict
+            {group name: list of reactions in the layer}, e.g. {soc: [soc]} or {hlgt: [pts]}
+            a reaction can belong to several groups
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug, group), whose fields are the same as make_table
+
+        """
+        # 0. init
+        start = time.time()
+        self.prep_drug([{"ctype":"ge", "key":"category", "value":category}])
+        self.prep_case([{"ctype":"ge", "key":"qualification", "value":qualification}])
+        conds = [
+            {"ctype":"in", "key":"case_id", "value":self.case_id},
+            {"ctype":"in", "key":"drug_id", "value":self.drug_id},
+            ]
+        # 1. npp
+        print("count npp...", end="")
+        npp = self._count_any("drug_rxn_table", "case_id", conds, inner_join="AND")
+        print("DONE")
+        # 2. count the groups
+        print("count groups...", end="")
+        groups = list(rxn_groups.keys())
+        mapping = [] # (rxn_id, group code)
+        for i, g in enumerate(groups):
+            mapping += [(r, i) for r in self._select_rxn(rxn_groups[g], layer)]
+        drugs = self._select_drug(drug_list)
+        np1, n1p, n11 = self._count_groups(conds, mapping, drugs)
+        print("DONE")
+        # 3. long-form table, drug major
+        drugs = drugs.tolist()
+        pos = {d:i for i, d in enumerate(drugs)}
+        mat = np.zeros((len(drugs), len(groups)), dtype=np.int64)
+        for d, g, n in n11:
+            mat[pos[d], g] = n
+        n11 = mat.ravel()
+        n1p = np.repeat([n1p.get(d, 0) for d in drugs], len(groups))
+        np1 = np.tile([np1.get(i, 0) for i in range(len(groups))], len(drugs))
+        result = _long_table(n11, n1p, np1, npp)
+        decoder = self._decode_drug(drugs)
+        result.index = pd.MultiIndex.from_product(
+            [[decoder[d] for d in drugs], groups], names=["drug", "group"]
+            )
+        self.table = result
+        self.__query = None # not a table of make_table
+        print("> completed")
+        elapsed = time.time() - start
+        h, rem = divmod(elapsed, 3600)
+        m, s = divmod(rem, 60)
+        print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+        return result
+
+
+    def make_strat_table(
+        self, drug_list:list=[], category:int=1,
+        rxn_list:list=[], layer:str="soc", qualification:int=2,
+        strata:list=["sex", "patient_age"], age_bins:list=[18, 45, 65],
+        ):
+        """
+        make the contingency tables of the drugs for each stratum of the cases
+        the cases are grouped by the fields of case_table in the aggregation,
+        instead of running make_table with prep_case for each stratum
+
+        Parameters
+        ----------
+        strata: list
+            fields of case_table to stratify the cases
+            sex, patient_age, event_country, qualification, stored_year, or event_quarter
+            event_quarter of the cases without the month of event_date is None
+
+        age_bins: list
+            edges of the bins of patient_age, e.g. [18, 45, 65] gives <18, 18-44, 45-64, and 65+
+            age 0 (not recorded) is binned as unknown
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug, strata), whose fields are the same as make_table
+        see calc_mh for the pooled ROR
+
+        """
+        strata = list(strata)
+        for k in strata:
+            if k not in STRATA:
+                raise KeyError(f"!! strata should be chosen from {STRATA} !!")
+        # 0. init
+        start = time.time()
+        self.prep_drug([{"ctype":"ge", "key":"category", "value":category}])
+        self.prep_case([{"ctype":"ge", "key":"qualification", "value":qualification}])
+        conds = [
+            {"ctype":"in", "key":"d.case_id", "value":self.case_id},
+            {"ctype":"in", "key":"d.drug_id", "value":self.drug_id},
+            ]
+        rxn = {"ctype":"in", "key":"d.rxn_id", "value":self._select_rxn(rxn_list, layer)}
+        drugs = self._select_drug(drug_list)
+        # 1. count
+        print("count strata...", end="")
+        margin, count = self._count_strata(conds, rxn, drugs, strata, age_bins)
+        print("DONE")
+        # 2. long-form table, drug major
+        keys = list(margin.keys())
+        drugs = drugs.tolist()
+        pos = {k:i for i, k in enumerate(keys)}
+        dpos = {d:i for i, d in enumerate(drugs)}
+        n1p = np.zeros((len(drugs), len(keys)), dtype=np.int64)
+        n11 = np.zeros((len(drugs), len(keys)), dtype=np.int64)
+        for k, v in count.items():
+            n1p[dpos[k[0]], pos[k[1:]]] = v[0]
+            n11[dpos[k[0]], pos[k[1:]]] = v[1]
+        n1p, n11 = n1p.ravel(), n11.ravel()
+        npp = np.tile([margin[k][0] for k in keys], len(drugs))
+        np1 = np.tile([margin[k][1] for k in keys], len(drugs))
+        result = _long_table(n11, n1p, np1, npp)
+        decoder = self._decode_drug(drugs)
+        tuples = [(decoder[d],) + k for d in drugs for k in keys]
+        result.index = pd.MultiIndex.from_tuples(tuples, names=["drug"] + strata)
+        self.table = result
+        self.__query = None # not a table of make_table
+        print("> completed")
+        elapsed = time.time() - start
+        h, rem = divmod(elapsed, 3600)
+        m, s = divmod(rem, 60)
+        print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+        return result
+
 
-        ## convert drug_id to drug_name
+    def make_time_table(
+        self, drug_list:list=[], category:int=1,
+        rxn_list:list=[], layer:str="soc", qualification:int=2,
+        period:str="stored_year", cumulative:bool=True,
+        ):
+        """
+        make the contingency tables of the drugs for each period
+        each case belongs to one period, so the counts of the periods are taken by one aggregation
+        and accumulated, which gives the tables of all the data up to each period
+
+        Parameters
+        ----------
+        period: str
+            stored_year or event_quarter (quarter of event_date)
+            cases without the period, such as event_date without the month, are excluded
+
+        cumulative: bool
+            whether the counts are accumulated over the periods, otherwise of each period
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug, period), whose fields are the same as make_table
+        calc_stat gives the trajectory of ROR, IC, etc.
+        the periods without any table (a zero margin), such as those before the first report
+        of the drug, are left out
+
+        """
+        if period not in {"stored_year", "event_quarter"}:
+            raise KeyError("!! period should be chosen from {stored_year, event_quarter} !!")
+        # 0. init
+        start = time.time()
+        self.prep_drug([{"ctype":"ge", "key":"category", "value":category}])
+        self.prep_case([{"ctype":"ge", "key":"qualification", "value":qualification}])
+        conds = [
+            {"ctype":"in", "key":"d.case_id", "value":self.case_id},
+            {"ctype":"in", "key":"d.drug_id", "value":self.drug_id},
+            ]
+        rxn = {"ctype":"in", "key":"d.rxn_id", "value":self._select_rxn(rxn_list, layer)}
+        drugs = self._select_drug(drug_list)
+        # 1. count each period
+        print("count periods...", end="")
+        margin, count = self._count_strata(conds, rxn, drugs, [period], [])
+        print("DONE")
+        # 2. prefix sums over the periods
+        periods = sorted([k[0] for k in margin.keys() if k[0] is not None])
+        drugs = drugs.tolist()
+        pos = {k:i for i, k in enumerate(periods)}
+        dpos = {d:i for i, d in enumerate(drugs)}
+        n1p = np.zeros((len(drugs), len(periods)), dtype=np.int64)
+        n11 = np.zeros((len(drugs), len(periods)), dtype=np.int64)
+        for k, v in count.items():
+            if k[1] is not None:
+                n1p[dpos[k[0]], pos[k[1]]] = v[0]
+                n11[dpos[k[0]], pos[k[1]]] = v[1]
+        npp = np.array([margin[(k,)][0] for k in periods], dtype=np.int64)
+        np1 = np.array([margin[(k,)][1] for k in periods], dtype=np.int64)
+        if cumulative:
+            n1p, n11 = np.cumsum(n1p, axis=1), np.cumsum(n11, axis=1)
+            npp, np1 = np.cumsum(npp), np.cumsum(np1)
+        n1p, n11 = n1p.ravel(), n11.ravel()
+        npp, np1 = np.tile(npp, len(drugs)), np.tile(np1, len(drugs))
+        result = _long_table(n11, n1p, np1, npp)
+        decoder = self._decode_drug(drugs)
+        result.index = pd.MultiIndex.from_product(
+            [[decoder[d] for d in drugs], periods], names=["drug", period]
+            )
+        ## chi-square is not defined for the tables with a zero margin
+        result = result[(result[["n1p", "n2p", "np1", "np2"]] > 0).all(axis=1)]
         self.table = result
+        self.__query = None # not a table of make_table
+        print("> completed")
+        elapsed = time.time() - start
+        h, rem = divmod(elapsed, 3600)
+        m, s = divmod(rem, 60)
+        print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+        return result
+
+
+    def calc_mh(self, table=None):
+        """
+        calculate the Mantel-Haenszel ROR pooled over the strata and its 95% CI
+        (Robins-Breslow-Greenland variance)
+
+        Parameters
+        ----------
+        table: pd.DataFrame
+            the output of make_strat_table, whose first index level is the pooled unit
+
+        Returns
+        -------
+        pd.DataFrame indexed by drug
+        n_strata is the number of the strata with both exposed and unexposed cases (0 < n1p < npp),
+        the others do not contribute to ROR_MH
+
+        """
+        if table is None:
+            table = self.table
+        drug = table.index.get_level_values(0)
+        code, uniques = pd.factorize(drug)
+        n11, n12, n21, n22 = [table[k].values for k in ["n11", "n12", "n21", "n22"]]
+        ror, lower, upper = self.__metrics.calc_mh(n11, n12, n21, n22, code)
+        crude = table[["n11", "n12", "n21", "n22"]].groupby(code).sum().values.T
+        informative = (table["n1p"].values > 0) & (table["n1p"].values < table["npp"].values)
+        n_strata = np.bincount(code, weights=informative, minlength=len(uniques)).astype(np.int64)
+        result = pd.DataFrame({
+            "n11":crude[0], "n_strata":n_strata,
+            "ROR_MH":ror, "lower_CI_MH":lower, "upper_CI_MH":upper,
+            "crude_ROR":self.__stats.calc_ror(*crude),
+            }, index=pd.Index(uniques, name=table.index.names[0]))
+        return result.sort_values("lower_CI_MH", ascending=False)
+
+
+    def make_pair_table(
+        self, category:int=1, qualification:int=2, min_n11:int=1, chunksize:int=1000000,
+        decode:bool=True, layer:str="pt",
+        ):
+        """
+        contingency tables of all the drug x PT pairs
+        drug_rxn_table is loaded once into sparse incidence matrices (see SparseCounter)
+        the PTs can be rolled up to a higher layer of MedDRA
+
+        Parameters
+        ----------
+        category: int
+            drugs whose category is equal to or greater than this are used
+
+        qualification: int
+            cases whose qualification is equal to or greater than this are used
+
+        min_n11: int
+            pairs whose n11 is less than this are not returned
+
+        chunksize: int
+            the number of records loaded at once
+
+        decode: bool
+            whether the drug names and the labels of the reactions (pt, hlt, hlgt, soc) are added
+
+        layer: str
+            pt, hlt, hlgt, or soc
+            the cases are counted for each term of the layer (a case is counted once in a term)
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug_id, rxn_id), or (drug_id, layer) if rolled up,
+        whose fields are the same as make_table
+
+        """
+        # 0. init
+        start = time.time()
+        # 1. incidence matrices
+        counter = self._load_counter(category, qualification, chunksize)
+        if layer != "pt":
+            M, terms = self._load_decoder("meddra").membership(counter.rxn_id, layer)
+            counter.rollup(M, terms, layer)
+        # 2. count
+        print("count pairs...", end="")
+        result = counter.count(min_n11)
+        if decode:
+            result = self._add_labels(result, {"drug_id":"drug_name"})
+        print("DONE")
+        self.table = result
+        self.__query = None # not a table of make_table
+        print("> completed")
+        elapsed = time.time() - start
+        h, rem = divmod(elapsed, 3600)
+        m, s = divmod(rem, 60)
+        print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+        return result
+
+
+    def make_interaction_table(
+        self, category:int=1, qualification:int=2, min_support:int=3, min_n111:int=1,
+        chunksize:int=1000000, decode:bool=True,
+        ):
+        """
+        screen the drug-drug interactions over all the co-reported drug pairs and the reactions
+        see Interaction for the counts and the scores
+
+        Parameters
+        ----------
+        min_support: int
+            drug pairs reported together in less than this number of cases are not screened
+
+        min_n111: int
+            triplets whose n111 is less than this are not returned
+
+        chunksize: int
+            the number of records loaded at once
+
+        decode: bool
+            whether the drug names and the labels of the reactions (pt, hlt, hlgt, soc) are added
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug_a, drug_b, rxn_id) with the counts and the scores
+
+        """
+        # 0. init
+        start = time.time()
+        # 1. incidence matrices
+        counter = self._load_counter(category, qualification, chunksize)
+        # 2. count
+        print("count triplets...", end="")
+        ddi = Interaction()
+        result = ddi.count(counter, min_support, min_n111)
+        result = ddi.calc_score(result)
+        if decode:
+            result = self._add_labels(result, {"drug_a":"drug_a_name", "drug_b":"drug_b_name"})
+        print("DONE")
         print("> completed")
         elapsed = time.time() - start
         h, rem = divmod(elapsed, 3600)
@@ -119,10 +685,40 @@ class Calculator:
         return result
 
 
-    def calc_stat(self, table=None):
+    def _load_counter(self, category:int, qualification:int, chunksize:int):
+        """ inner method to load the records into SparseCounter """
+        self.prep_drug([{"ctype":"ge", "key":"category", "value":category}])
+        self.prep_case([{"ctype":"ge", "key":"qualification", "value":qualification}])
+        conds = [
+            {"ctype":"in", "key":"case_id", "value":self.case_id},
+            {"ctype":"in", "key":"drug_id", "value":self.drug_id},
+            ]
+        txt, params, temps = self.tmake.simple_query(conds, "AND")
+        order = f"SELECT case_id, drug_id, rxn_id FROM drug_rxn_table WHERE {txt}"
+        print("load records...")
+        counter = SparseCounter()
+        with self._connect() as conn:
+            for content in tqdm(self._fetch_chunks(conn, order, params, temps, chunksize)):
+                counter.add(content)
+        return counter.build()
+
+
+    def calc_stat(self, table=None, ebgm:bool=False, prior:dict=None):
         """
         calculate statistics from the contingency table
-        
+        ROR, chi-square, IC, and PRR with their intervals, and EBGM with EB05 and EB95 if ebgm
+
+        Parameters
+        ----------
+        ebgm: bool
+            whether EBGM is calculated
+
+        prior: dict
+            the prior of MGPS, which is fitted to the table if None
+            the fit needs many pairs such as the output of make_pair_table,
+            so give the prior fitted to it for the small tables of make_table
+            see SignalMetrics.fit_prior
+
         """
         if table is None:
             if self.table.empty:
@@ -140,6 +736,21 @@ class Calculator:
         table.loc[:, "adjusted_p_value_BH"] = q_bh
         table.loc[:, "adjusted_p_value_Holm"] = q_holm
         table.loc[:, "p_value"] = p
+        # Bayesian and other measures
+        ic, ic_lower, ic_upper = self.__metrics.calc_ic(n11, n12, n21, n22)
+        table.loc[:, "IC"] = ic
+        table.loc[:, "IC_lower"] = ic_lower
+        table.loc[:, "IC_upper"] = ic_upper
+        prr, prr_lower, prr_upper = self.__metrics.calc_prr(n11, n12, n21, n22)
+        table.loc[:, "PRR"] = prr
+        table.loc[:, "PRR_lower_CI"] = prr_lower
+        table.loc[:, "PRR_upper_CI"] = prr_upper
+        if ebgm:
+            eb, eb05, eb95 = self.__metrics.calc_ebgm(n11, n12, n21, n22, prior)
+            self.prior = self.__metrics.prior if prior is None else prior # reusable for other tables
+            table.loc[:, "EBGM"] = eb
+            table.loc[:, "EB05"] = eb05
+            table.loc[:, "EB95"] = eb95
         table = table.sort_values("lower_CI", ascending=False)
         self.table = table
         return table
@@ -148,78 +759,665 @@ class Calculator:
     def integrate_drug(self, name="", drugs=[]):
         """
         merge counts of the indicated drugs
-        
+        the cases of the drugs are united, so a case with several of them is counted once
+
         Parameters
         ----------
         name: str
             indicates the drug name after integration
 
         drugs: list
-            indicates the drugs to be integrated
-        
+            indicates the drugs to be integrated, names in the table of make_table
+
         """
+        query = self._check_query(self.table)
         if len(name)==0:
             name = "integrated_drug"
-        merge = [v for v in drugs if v in self.drug]
+        decoder = query["drug"]
+        merge = [v for v in drugs if v in decoder]
         if len(merge) > 1:
-            rest = [v for v in self.drug if v not in merge]
-            temp = self.res.loc[merge,:]
-            npp = temp.loc[:, "npp"].values[0]
-            np1 = temp.loc[:, "np1"].values[0]
-            np2 = temp.loc[:, "np2"].values[0]
-            n1p = np.sum(temp["n1p"])
-            n2p = npp - n1p
-            n11 = np.sum(temp["n11"])
-            n12 = np.sum(temp["n12"])
-            n21 = np1 - n11
-            n22 = np2 - n12
-            col = ["n11", "n12", "n1p", "n21", "n22", "n2p", "np1", "np2", "npp"]
-            rest = self.res.loc[rest, col]
-            df = pd.DataFrame([n11, n12, n1p, n21, n22, n2p, np1, np2, npp],index=col,columns=[name]).T
+            table = self.table[["n11", "n12", "n1p", "n21", "n22", "n2p", "np1", "np2", "npp"]]
+            rest = table.loc[[v for v in table.index if v not in merge]]
+            conds = [
+                {"ctype":"in", "key":"d.case_id", "value":self.case_id},
+                {"ctype":"in", "key":"d.drug_id", "value":self.drug_id},
+                ]
+            rxn = {"ctype":"in", "key":"d.rxn_id", "value":query["rxn_id"]}
+            counts = self._count_drug_groups(conds, rxn, [(decoder[v], 0) for v in merge])
+            n1p, n11 = counts.get(0, (0, 0))
+            npp = table["npp"].values[0]
+            np1 = table["np1"].values[0]
+            df = _long_table(np.array([n11]), np.array([n1p]), np.array([np1]), np.array([npp]))
+            df.index = [name]
             rest = pd.concat([rest, df], join="inner", axis=0)
-            self.calc_stat(rest)
+            query["integrated"].add(name)
+            return self.calc_stat(rest)
         else:
             print("CAUTION: no integration because the indicated drugs are not enough")
 
 
+    def _check_query(self, table:pd.DataFrame):
+        """
+        inner method to check that the table is of the last make_table
+        (possibly with the drugs of integrate_drug) and return its query
+
+        """
+        if (self.__query is None) or (table is None):
+            raise ValueError("!! the last table is not of make_table: run make_table() before this process !!")
+        query = self.__query
+        if isinstance(table.index, pd.MultiIndex):
+            raise ValueError("!! the table should be indexed by the drugs of the last make_table, not a table of the other methods !!")
+        known = set(query["drug"]) | query["integrated"]
+        unknown = [v for v in table.index if v not in known]
+        if len(unknown) > 0:
+            raise ValueError(f"!! {unknown[:5]} are not the drugs of the last make_table !!")
+        if not ((table["np1"] == query["np1"]).all() & (table["npp"] == query["npp"]).all()):
+            raise ValueError("!! the margins of the table differ from those of the last make_table !!")
+        return query
+
+
+    def make_group_table(
+        self, drug_groups:dict, category:int=1,
+        rxn_list:list=[], layer:str="soc", qualification:int=2,
+        ):
+        """
+        make the contingency tables of the groups of drugs such as ATC classes
+        n1p and n11 of a group are the distinct cases that have any drug of the group
+
+        Parameters
+        ----------
+        drug_groups: dict
+            {group name: list of drug names}, a drug can belong to several groups
+
+        Returns
+        -------
+        pd.DataFrame indexed by group, whose fields are the same as make_table
+
+        """
+        # 0. init
+        start = time.time()
+        self.prep_drug([{"ctype":"ge", "key":"category", "value":category}])
+        self.prep_case([{"ctype":"ge", "key":"qualification", "value":qualification}])
+        conds = [
+            {"ctype":"in", "key":"d.case_id", "value":self.case_id},
+            {"ctype":"in", "key":"d.drug_id", "value":self.drug_id},
+            ]
+        # 1. npp and np1
+        print("count npp, np1...", end="")
+        rxn = {"ctype":"in", "key":"d.rxn_id", "value":self._select_rxn(rxn_list, layer)}
+        npp = self._count_any("drug_rxn_table AS d", "d.case_id", conds, inner_join="AND")
+        np1 = self._count_any("drug_rxn_table AS d", "d.case_id", conds + [rxn], inner_join="AND")
+        print("DONE")
+        # 2. groups
+        print("count groups...", end="")
+        groups = list(drug_groups.keys())
+        names = {v.lower() for g in groups for v in drug_groups[g]}
+        cond = {"ctype":"in", "key":"drug_name", "value":tuple(names)}
+        txt, params, temps = self.tmake.simple_query([cond], "AND")
+        with self._connect() as conn:
+            content = self._fetch(conn, f"SELECT drug_name, drug_id FROM drug_dict WHERE {txt}", params, temps)
+        encoder = dict() # {drug_name: {drug_id}}
+        for k, v in content:
+            encoder.setdefault(k, set()).add(v)
+        mapping = set() # (drug_id, group code)
+        for i, g in enumerate(groups):
+            for v in drug_groups[g]:
+                mapping |= {(d, i) for d in encoder.get(v.lower(), set()) if d in self.drug_id}
+        counts = self._count_drug_groups(conds, rxn, list(mapping))
+        print("DONE")
+        # 3. table
+        n1p = np.array([counts.get(i, (0, 0))[0] for i in range(len(groups))], dtype=np.int64)
+        n11 = np.array([counts.get(i, (0, 0))[1] for i in range(len(groups))], dtype=np.int64)
+        result = _long_table(n11, n1p, np.full(len(groups), np1), np.full(len(groups), npp))
+        result.index = pd.Index(groups, name="group")
+        self.table = result
+        self.__query = None # not a table of make_table
+        print("> completed")
+        elapsed = time.time() - start
+        h, rem = divmod(elapsed, 3600)
+        m, s = divmod(rem, 60)
+        print(f"elapsed time: {int(h)} hr {int(m)} min {s:.1f} sec")
+        return result
+
+
+    def invalidate_cache(self, all_db:bool=False):
+        """ remove the cached results of this database, or of all the databases """
+        if self.cache is None:
+            return 0
+        if all_db:
+            return self.cache.invalidate()
+        return self.cache.invalidate(self.db_path)
+
+
     def _select_any(
         self, name_table:str, name_field:str, conditions:list, inner_join:str="AND"
         ):
         """ inner method to select records """
-        # prepare text
-        txt = self.tmake.simple_text(conditions, inner_join)
+        # prepare query
+        txt, params, temps = self.tmake.simple_query(conditions, inner_join)
         # select
-        with closing(sqlite3.connect(self.db_path)) as conn:
-            cur = conn.cursor()
-            order = f"SELECT {name_field} FROM {name_table} WHERE {txt}"
-            cur.execute(order)
-            content = cur.fetchall()
+        order = f"SELECT {name_field} FROM {name_table} WHERE {txt}"
+        with self._connect() as conn:
+            content = self._fetch(conn, order, params, temps)
             content = set(map(lambda x: x[0], content))
             return content
 
 
+    def _select_ids(
+        self, name_table:str, name_field:str, conditions:list, inner_join:str="AND"
+        ):
+        """ inner method to select integer IDs as IDSet """
+        txt, params, temps = self.tmake.simple_query(conditions, inner_join)
+        order = f"SELECT {name_field} FROM {name_table} WHERE {txt}"
+        res = [np.array([], dtype=np.int64)]
+        with self._connect() as conn:
+            for content in self._fetch_chunks(conn, order, params, temps, 100000):
+                res.append(np.fromiter(map(itemgetter(0), content), dtype=np.int64, count=len(content)))
+        return IDSet(np.concatenate(res)) # duplicates are removed here
+
+
     def _count_any(
         self, name_table:str, name_field:str, conditions:list=[], inner_join:str="AND"
         ):
         """ inner method to count records """
-        with closing(sqlite3.connect(self.db_path)) as conn:
+        order, params, temps = self._count_order(name_table, name_field, conditions, inner_join)
+        with self._connect() as conn:
+            n = self._fetch(conn, order, params, temps)[0][0]
+            return n
+
+
+    def _count_grouped(self, conditions:list, rxn_condition:dict, drugs):
+        """
+        inner method to count n1p and n11 of all the drugs with one aggregation
+
+        Returns
+        -------
+        dict {drug_id: (n1p, n11)}, drugs without records are not included
+
+        """
+        if self.n_jobs > 1:
+            # chunks of the drugs, more than the threads to balance the load
+            drugs = IDSet(drugs).values
+            chunks = np.array_split(drugs, min(4 * self.n_jobs, max(len(drugs), 1)))
+            orders = [self._grouped_order(conditions, rxn_condition, IDSet(v, is_sorted=True)) for v in chunks]
+            content = [v for res in self._fetch_many(orders) for v in res]
+        else:
+            order, params, temps = self._grouped_order(conditions, rxn_condition, drugs)
+            with self._connect() as conn:
+                content = self._fetch(conn, order, params, temps)
+        return {v[0]:(v[1], v[2]) for v in content}
+
+
+    def _count_loop(self, conditions:list, rxn_condition:dict, drugs):
+        """
+        inner method to count n1p and n11 of each drug with two queries
+        the queries are prepared once and only drug_id is bound for each drug
+
+        Returns
+        -------
+        dict {drug_id: (n1p, n11)}
+
+        """
+        focus = {"ctype":"equal", "key":"drug_id", "value":0} # the first placeholder
+        n1p = self._count_order("drug_rxn_table", "case_id", [focus] + conditions)
+        n11 = self._count_order("drug_rxn_table", "case_id", [focus] + conditions + [rxn_condition])
+        orders = []
+        for d in drugs:
+            orders.append((n1p[0], [int(d)] + n1p[1][1:], n11[2]))
+            orders.append((n11[0], [int(d)] + n11[1][1:], n11[2]))
+        content = self._fetch_many(orders)
+        return {d:(content[2*i][0][0], content[2*i + 1][0][0]) for i, d in enumerate(drugs)}
+
+
+    def _count_groups(self, conditions:list, mapping:list, drugs):
+        """
+        inner method to count np1 of the groups, n1p of the drugs, and n11 of the drug x group
+        the reactions are joined with their groups through a temp table
+
+        Returns
+        -------
+        dict {group code: np1}, dict {drug_id: n1p}, and a list of (drug_id, group code, n11)
+        keys without records are not included
+
+        """
+        join = "drug_rxn_table AS d JOIN temp.rxn_group AS g ON d.rxn_id = g.rxn_id"
+        cond = {"ctype":"in", "key":"drug_id", "value":drugs}
+        with self._connect() as conn:
             cur = conn.cursor()
-            if len(conditions) > 0:
-                # prepare text
-                txt = self.tmake.simple_text(conditions, inner_join)
-                order = f"SELECT COUNT (DISTINCT {name_field}) FROM {name_table} WHERE {txt}"
+            cur.execute("DROP TABLE IF EXISTS temp.rxn_group")
+            cur.execute(
+                "CREATE TEMP TABLE rxn_group (rxn_id INTEGER, grp INTEGER, PRIMARY KEY (rxn_id, grp)) WITHOUT ROWID"
+                )
+            cur.executemany("INSERT OR IGNORE INTO temp.rxn_group (rxn_id, grp) VALUES (?, ?)", sorted(mapping))
+            conn.commit()
+            try:
+                txt, params, temps = self.tmake.simple_query(conditions, "AND")
+                order = f"SELECT g.grp, COUNT (DISTINCT d.case_id) FROM {join} WHERE {txt} GROUP BY g.grp"
+                np1 = self._fetch(conn, order, params, temps)
+                txt, params, temps = self.tmake.simple_query(conditions + [cond], "AND")
+                order = f"SELECT drug_id, COUNT (DISTINCT case_id) FROM drug_rxn_table WHERE {txt} GROUP BY drug_id"
+                n1p = self._fetch(conn, order, params, temps)
+                order = f"SELECT d.drug_id, g.grp, COUNT (DISTINCT d.case_id) FROM {join} WHERE {txt} "
+                order += "GROUP BY d.drug_id, g.grp"
+                n11 = self._fetch(conn, order, params, temps)
+            finally:
+                cur.execute("DROP TABLE IF EXISTS temp.rxn_group")
+                conn.commit()
+        return dict(np1), dict(n1p), n11
+
+
+    def _count_masked(self, mask_id, rxn_id, drugs):
+        """
+        inner method to count npp, np1, and n1p and n11 of the drugs
+        within the cases that have any of the masking drugs
+
+        Returns
+        -------
+        npp, np1, and dict {drug_id: (n1p, n11)}
+
+        """
+        case = {"ctype":"in", "key":"case_id", "value":self.case_id}
+        mask = {"ctype":"in", "key":"drug_id", "value":mask_id}
+        drug = {"ctype":"in", "key":"d.drug_id", "value":self.drug_id}
+        focus = {"ctype":"in", "key":"d.drug_id", "value":drugs}
+        rxn = {"ctype":"in", "key":"d.rxn_id", "value":rxn_id}
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("DROP TABLE IF EXISTS temp.masked")
+            cur.execute("CREATE TEMP TABLE masked (case_id INTEGER PRIMARY KEY)")
+            txt, params, temps = self.tmake.simple_query([mask, case], "AND")
+            self._create_temps(cur, temps)
+            cur.execute(f"INSERT OR IGNORE INTO temp.masked SELECT case_id FROM drug_rxn_table WHERE {txt}", params)
+            conn.commit()
+            try:
+                # the masked cases drive the search
+                join = "temp.masked AS m CROSS JOIN drug_rxn_table AS d ON d.case_id = m.case_id"
+                r, params, temps = self.tmake.simple_query([rxn], "AND")
+                cnt = f"COUNT (DISTINCT d.case_id), COUNT (DISTINCT CASE WHEN {r} THEN d.case_id END)"
+                txt, p, temps = self.tmake.simple_query([drug], "AND", temps)
+                order = f"SELECT {cnt} FROM {join} WHERE {txt}"
+                npp, np1 = self._fetch(conn, order, params + p, temps)[0]
+                r, params, temps = self.tmake.simple_query([rxn], "AND")
+                txt, p, temps = self.tmake.simple_query([drug, focus], "AND", temps)
+                order = f"SELECT d.drug_id, {cnt} FROM {join} WHERE {txt} GROUP BY d.drug_id"
+                counts = {v[0]:(v[1], v[2]) for v in self._fetch(conn, order, params + p, temps)}
+            finally:
+                cur.execute("DROP TABLE IF EXISTS temp.masked")
+                conn.commit()
+        return npp, np1, counts
+
+
+    def _count_drug_groups(self, conditions:list, rxn_condition:dict, mapping:list):
+        """
+        inner method to count n1p and n11 of the groups of drugs
+        the drugs are joined with their groups through a temp table
+
+        Returns
+        -------
+        dict {group code: (n1p, n11)}, groups without records are not included
+
+        """
+        join = "drug_rxn_table AS d JOIN temp.drug_group AS g ON d.drug_id = g.drug_id"
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute("DROP TABLE IF EXISTS temp.drug_group")
+            cur.execute(
+                "CREATE TEMP TABLE drug_group (drug_id INTEGER, grp INTEGER, PRIMARY KEY (drug_id, grp)) WITHOUT ROWID"
+                )
+            cur.executemany("INSERT OR IGNORE INTO temp.drug_group (drug_id, grp) VALUES (?, ?)", sorted(mapping))
+            conn.commit()
+            try:
+                rxn, params, temps = self.tmake.simple_query([rxn_condition], "AND")
+                txt, p, temps = self.tmake.simple_query(conditions, "AND", temps)
+                order = f"SELECT g.grp, COUNT (DISTINCT d.case_id), "
+                order += f"COUNT (DISTINCT CASE WHEN {rxn} THEN d.case_id END) "
+                order += f"FROM {join} WHERE {txt} GROUP BY g.grp"
+                content = self._fetch(conn, order, params + p, temps)
+            finally:
+                cur.execute("DROP TABLE IF EXISTS temp.drug_group")
+                conn.commit()
+        return {v[0]:(v[1], v[2]) for v in content}
+
+
+    def _count_strata(self, conditions:list, rxn_condition:dict, drugs, strata:list, age_bins:list):
+        """
+        inner method to count npp and np1 of each stratum, and n1p and n11 of each drug x stratum
+
+        Returns
+        -------
+        dict {stratum: (npp, np1)} and dict {(drug_id,) + stratum: (n1p, n11)}
+        stratum is a tuple of the labels of the strata
+
+        """
+        expr = []
+        for k in strata:
+            if k == "patient_age":
+                # 0 of patient_age is not recorded
+                e = "CASE WHEN c.patient_age IS NULL OR c.patient_age <= 0 THEN -1 "
+                e += " ".join([f"WHEN c.patient_age < {int(b)} THEN {i}" for i, b in enumerate(age_bins)])
+                expr.append(e + f" ELSE {len(age_bins)} END")
+            elif k == "event_quarter":
+                expr.append(QUARTER)
             else:
-                order = f"SELECT COUNT (DISTINCT {name_field}) FROM {name_table}"
-            cur.execute(order)
-            n = cur.fetchall()[0][0]
-            return n
+                expr.append(f"c.{k}")
+        group = ", ".join(expr)
+        join = "drug_rxn_table AS d JOIN case_table AS c ON d.case_id = c.case_id"
+        rxn, params, temps = self.tmake.simple_query([rxn_condition], "AND")
+        cnt = f"COUNT (DISTINCT d.case_id), COUNT (DISTINCT CASE WHEN {rxn} THEN d.case_id END)"
+        with self._connect() as conn:
+            txt, p, temps = self.tmake.simple_query(conditions, "AND", temps)
+            order = f"SELECT {group}, {cnt} FROM {join} WHERE {txt} GROUP BY {group}"
+            margin = self._fetch(conn, order, params + p, temps)
+            cond = {"ctype":"in", "key":"d.drug_id", "value":drugs}
+            rxn, params, temps = self.tmake.simple_query([rxn_condition], "AND")
+            txt, p, temps = self.tmake.simple_query(conditions + [cond], "AND", temps)
+            order = f"SELECT d.drug_id, {group}, {cnt} FROM {join} WHERE {txt} GROUP BY d.drug_id, {group}"
+            count = self._fetch(conn, order, params + p, temps)
+        labels = _age_labels(age_bins)
+        def label(v):
+            return tuple(labels[x] if k == "patient_age" else x for k, x in zip(strata, v))
+        n = len(strata)
+        margin = {label(v[:n]):(v[n], v[n + 1]) for v in margin}
+        count = {(v[0],) + label(v[1:n + 1]):(v[n + 1], v[n + 2]) for v in count}
+        return margin, count
+
+
+    def _grouped_order(self, conditions:list, rxn_condition:dict, drugs):
+        """ inner method to prepare the query of _count_grouped """
+        cond = {"ctype":"in", "key":"drug_id", "value":drugs}
+        rxn, params, temps = self.tmake.simple_query([rxn_condition], "AND")
+        txt, p, temps = self.tmake.simple_query(conditions + [cond], "AND", temps)
+        order = f"SELECT drug_id, COUNT (DISTINCT case_id), "
+        order += f"COUNT (DISTINCT CASE WHEN {rxn} THEN case_id END) " # NULL is not counted
+        order += f"FROM drug_rxn_table WHERE {txt} GROUP BY drug_id"
+        return order, params + p, temps
+
+
+    def _count_order(
+        self, name_table:str, name_field:str, conditions:list=[], inner_join:str="AND"
+        ):
+        """ inner method to prepare the query of _count_any """
+        if len(conditions) > 0:
+            # prepare query
+            txt, params, temps = self.tmake.simple_query(conditions, inner_join)
+            return f"SELECT COUNT (DISTINCT {name_field}) FROM {name_table} WHERE {txt}", params, temps
+        else:
+            return f"SELECT COUNT (DISTINCT {name_field}) FROM {name_table}", [], dict()
+
+
+    def _connect(self):
+        """ the long-lived read-only connection, opened if not yet """
+        if self._conn is None:
+            self.open()
+        return nullcontext(self._conn)
+
+
+    def _new_conn(self, check_same_thread:bool=True):
+        """ inner method to open a read-only connection """
+        mmap_mb, cache_mb = self._pragma
+        uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        conn = sqlite3.connect(
+            uri, uri=True, cached_statements=256, # prepared statements are reused
+            check_same_thread=check_same_thread,
+            )
+        conn.execute(f"PRAGMA mmap_size={int(mmap_mb * 2**20)}")
+        conn.execute(f"PRAGMA cache_size={-int(cache_mb * 1024)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+
+    def _worker_conn(self):
+        """ inner method to get the connection of the current thread of the pool """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # used only by this thread but closed by close() in the main thread
+            conn = self._new_conn(check_same_thread=False)
+            self._local.conn = conn
+            with self._lock:
+                self._pool_conns.append(conn)
+        return conn
+
+
+    def _set_wal(self):
+        """
+        inner method to switch the database to WAL mode, where the readers and a writer do not block each other
+        the mode is persistent, and kept as is if the file cannot be written
+
+        """
+        with self._connect() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if mode.lower() == "wal":
+            return
+        try:
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError as e: # read-only file or locked
+            print(f"!! WAL mode is not available: {e} !!")
+
+
+    def _fetch_many(self, orders:list):
+        """
+        inner method to execute the prepared queries, [(order, params, temps)], and return the results in order
+        run by the thread pool with a read-only connection for each thread if n_jobs > 1
+        the temp tables are loaded into each connection once and reused as in _fetch
+
+        """
+        keys = dict() # the keys of the shared temps are computed once
+        for _, _, temps in orders:
+            if id(temps) not in keys:
+                keys[id(temps)] = {k:_temp_key(v) for k, v in temps.items()}
+        def run(conn, order, params, temps):
+            cur = conn.cursor()
+            self._create_temps(cur, temps, keys[id(temps)])
+            cur.execute(order, params)
+            return cur.fetchall()
+        if self.n_jobs <= 1:
+            with self._connect() as conn:
+                return [run(conn, *v) for v in orders]
+        if self._pool is None:
+            if self.wal & (not self.immutable):
+                self._set_wal()
+            self._pool = ThreadPoolExecutor(self.n_jobs, thread_name_prefix="faersutil")
+        return list(self._pool.map(lambda v: run(self._worker_conn(), *v), orders))
+
+
+    def _fetch(self, conn, order:str, params:list, temps:dict):
+        """
+        inner method to execute the parameterized query
+        the large sets of the conditions are loaded into temp tables, which are kept for the next query
+
+        """
+        cur = conn.cursor()
+        self._create_temps(cur, temps)
+        cur.execute(order, params)
+        return cur.fetchall()
+
+
+    def _fetch_chunks(self, conn, order:str, params:list, temps:dict, chunksize:int=1000000):
+        """ inner method to execute the parameterized query and yield the results by chunk """
+        cur = conn.cursor()
+        self._create_temps(cur, temps)
+        cur.execute(order, params)
+        while True:
+            content = cur.fetchmany(chunksize)
+            if len(content) == 0:
+                break
+            yield content
+
+
+    def _create_temps(self, cur, temps:dict, keys:dict=None):
+        """
+        inner method to load the large sets of the conditions into temp tables
+        a temp table already loaded with the same values is reused
+        the temp tables belong to the connection of the cursor
+
+        """
+        loaded = self._temp_keys.setdefault(cur.connection, dict())
+        for k, v in temps.items():
+            key = _temp_key(v) if keys is None else keys[k]
+            if loaded.get(k) == key:
+                continue
+            loaded.pop(k, None)
+            cur.execute(f"DROP TABLE IF EXISTS temp.{k}")
+            if isinstance(v, IDSet):
+                cur.execute(f"CREATE TEMP TABLE {k} (v INTEGER PRIMARY KEY)")
+                v = v.tolist() # sorted, appending to the b-tree is faster
+            elif set(map(type, v)) <= {int}:
+                cur.execute(f"CREATE TEMP TABLE {k} (v INTEGER PRIMARY KEY)")
+                v = sorted(v)
+            else:
+                cur.execute(f"CREATE TEMP TABLE {k} (v PRIMARY KEY)")
+            cur.executemany(f"INSERT OR IGNORE INTO temp.{k} (v) VALUES (?)", zip(v))
+            cur.connection.commit() # not to hold the lock of the database
+            loaded[k] = key
+
+
+    def check_plan(self):
+        """
+        check whether the queries of make_table use the indexes of drug_rxn_table
+
+        Returns
+        -------
+        pd.DataFrame of the query plan of npp, np1, n1p, n11, and the grouped count
+
+        """
+        # case_id is given as a large set as in make_table
+        case = {"ctype":"in", "key":"case_id", "value":tuple(range(self.tmake.max_params + 1))}
+        drug = {"ctype":"in", "key":"drug_id", "value":(0, 1)}
+        rxn = {"ctype":"in", "key":"rxn_id", "value":(0, 1)}
+        focus = {"ctype":"equal", "key":"drug_id", "value":0}
+        queries = {
+            "npp":[case, drug], "np1":[case, drug, rxn],
+            "n1p":[case, drug, focus], "n11":[case, drug, focus, rxn],
+            }
+        res = []
+        with self._connect() as conn:
+            orders = {k:self._count_order("drug_rxn_table", "case_id", v) for k, v in queries.items()}
+            orders["grouped"] = self._grouped_order([case, drug], rxn, (0, 1))
+            for k, (order, params, temps) in orders.items():
+                plan = self._fetch(conn, f"EXPLAIN QUERY PLAN {order}", params, temps)
+                plan = [p[3] for p in plan if "drug_rxn_table" in p[3]]
+                plan = " | ".join(plan)
+                res.append([k, plan, ("INDEX" in plan) & ("SCAN drug_rxn_table" not in plan)])
+        return pd.DataFrame(res, columns=["count", "plan", "index_used"]).set_index("count")
+
+
+    def decode_drug(self, drug_id):
+        """
+        representative names of the drugs
+
+        Parameters
+        ----------
+        drug_id: array-like
+
+        Returns
+        -------
+        np.ndarray of the names, None for unknown IDs
+
+        """
+        decoder = self._load_decoder("drug")
+        res = decoder.reindex(np.asarray(list(drug_id), dtype=np.int64)).values
+        return np.where(pd.isna(res), None, res)
+
+
+    def decode_rxn(self, rxn_id=None, layers:list=["pt", "hlt", "hlgt", "soc"]):
+        """
+        labels of the reactions in the layers of MedDRA
+        a PT under several upper terms has them joined by '|'
+
+        Parameters
+        ----------
+        rxn_id: array-like
+            the reactions of the last make_table if None
+
+        Returns
+        -------
+        pd.DataFrame indexed by rxn_id
+
+        """
+        if rxn_id is None:
+            if self.__query is None:
+                raise ValueError("!! Give rxn_id or run make_table() before this process !!")
+            rxn_id = self.__query["rxn_id"]
+        decoder = self._load_decoder("rxn")
+        return decoder.reindex(np.asarray(list(rxn_id), dtype=np.int64))[layers]
+
+
+    def _decode_drug(self, drugs):
+        """ {drug_id: representative drug_name} """
+        drugs = list(drugs)
+        names = self.decode_drug(drugs)
+        assert not any(v is None for v in names) # representative should exist
+        return dict(zip(drugs, names))
+
+
+    def _load_decoder(self, name:str):
+        """
+        inner method to load a dimension table into memory at the first use
+        - drug: pd.Series of the representative name indexed by drug_id,
+          the name of drug_table is used if the representative is not unique
+        - rxn: pd.DataFrame of pt, hlt, hlgt, and soc indexed by rxn_id
+        - meddra: MedDRAIndex of the hierarchy
+
+        """
+        if name in self.__decoder:
+            return self.__decoder[name]
+        with self._connect() as conn:
+            if name == "drug":
+                rep = pd.read_sql("SELECT drug_id, drug_name FROM drug_dict WHERE representative = 1", conn)
+                rep = rep.drop_duplicates("drug_id", keep=False)
+                rep = pd.Series(rep["drug_name"].values, index=rep["drug_id"].values)
+                table = pd.read_sql("SELECT drug_id, drug_name FROM drug_table", conn)
+                table = pd.Series(table["drug_name"].values, index=table["drug_id"].values)
+                decoder = rep.combine_first(table)
+            elif name == "rxn":
+                df = pd.read_sql("SELECT rxn_id, pt, hlt, hlgt, soc FROM rxn_table", conn)
+                decoder = pd.DataFrame(index=np.unique(df["rxn_id"].values))
+                for k in ["pt", "hlt", "hlgt", "soc"]:
+                    tmp = df[["rxn_id", k]].dropna().drop_duplicates().sort_values(["rxn_id", k])
+                    if tmp["rxn_id"].is_unique:
+                        decoder[k] = tmp.set_index("rxn_id")[k]
+                    else:
+                        decoder[k] = tmp.groupby("rxn_id")[k].agg("|".join)
+            elif name == "meddra":
+                decoder = MedDRAIndex(pd.read_sql("SELECT rxn_id, pt, hlt, hlgt, soc FROM rxn_table", conn))
+            else:
+                raise KeyError("!! name should be chosen from {drug, rxn, meddra} !!")
+        self.__decoder[name] = decoder
+        return decoder
+
+
+    def _add_labels(self, table:pd.DataFrame, drugs:dict):
+        """
+        inner method to add the drug names and the labels of the reactions to the table
+        indexed by the drug IDs and rxn_id
+
+        Parameters
+        ----------
+        drugs: dict
+            {index level of drug_id: field of the name}
+
+        """
+        table = table.copy()
+        for k, v in drugs.items():
+            ids = table.index.get_level_values(k)
+            code, uniques = pd.factorize(ids)
+            table[v] = self.decode_drug(uniques)[code]
+        if "rxn_id" in table.index.names: # not rolled up
+            code, uniques = pd.factorize(table.index.get_level_values("rxn_id"))
+            labels = self.decode_rxn(uniques)
+            for k in labels.columns:
+                table[k] = labels[k].values[code]
+        return table
 
 
     def _select_drug(self, drug_list:list):
         """ select drug based on the given name list """
         tmp = [d.lower() for d in drug_list]
         condition = {"ctype":"in", "key":"drug_name", "value":tuple(tmp)}
-        tmp = self._select_any("drug_dict", "drug_id", [condition])
+        tmp = self._select_ids("drug_dict", "drug_id", [condition])
         if len(tmp) == 0:
             raise ValueError("!! No drugs were selected: check the given list !!")
         if len(self.drug_id) == 0:
@@ -231,15 +1429,22 @@ class Calculator:
     def _select_rxn(self, rxn_list:list, layer:str="soc"):
         """
         select reactions based on the given rxn list
+        the terms are expanded to the PTs under them with the MedDRA index
+
+        Parameters
+        ----------
+        rxn_list: list or dict
+            terms in the layer, those ending with '*' are prefixes such as 'cardiac*'
+            {layer: terms} selects the terms of several layers at once
 
         """
-        tmp = [d.lower() for d in rxn_list]
-        if len(rxn_list) == 1:
-            condition = {"ctype":"match", "key":layer, "value":tmp[0]}
+        if isinstance(rxn_list, dict):
+            terms = {k:[d.lower() for d in v] for k, v in rxn_list.items()}
         else:
-            condition = {"ctype":"in", "key":layer, "value":tuple(tmp)}
-        tmp = self._select_any("rxn_table", "rxn_id", [condition])
-        assert len(tmp) >= len(rxn_list)
+            terms = [d.lower() for d in rxn_list]
+        tmp, unknown = self._load_decoder("meddra").select(terms, layer)
+        if len(unknown) > 0:
+            raise ValueError(f"!! unknown reactions: {unknown} !!")
         if len(self.rxn_id) == 0:
             return tmp
         else:
@@ -250,14 +1455,18 @@ class Calculator:
         """
         select drug based on the given conditions
 
-        conditions: a list of dict
+        conditions: a list of dict or IDSet
             dict keys (ctype, key, value)
+            IDSet is used as the selected IDs as is
 
         inner_join: str
             how to concatenate conditions
 
         """
-        tmp = self._select_any("drug_table", "drug_id", conditions, inner_join)
+        if isinstance(conditions, IDSet):
+            tmp = conditions
+        else:
+            tmp = self._select_ids("drug_table", "drug_id", conditions, inner_join)
         if if_exists.lower() == "replace":
             self.drug_id = tmp
         elif if_exists.lower() == "and":
@@ -277,14 +1486,18 @@ class Calculator:
 
         Parameters
         ----------
-        conditions: a list of dict
+        conditions: a list of dict or IDSet
             dict keys (ctype, key, value)
+            IDSet is used as the selected IDs as is
 
         inner_join: str
             how to concatenate conditions
 
         """
-        tmp = self._select_any("rxn_table", "rxn_id", conditions, inner_join)
+        if isinstance(conditions, IDSet):
+            tmp = conditions
+        else:
+            tmp = self._select_ids("rxn_table", "rxn_id", conditions, inner_join)
         if if_exists.lower() == "replace":
             self.rxn_id = tmp
         elif if_exists.lower() == "and":
@@ -304,14 +1517,18 @@ class Calculator:
 
         Parameters
         ----------
-        conditions: a list of dict
+        conditions: a list of dict or IDSet
             dict keys (ctype, key, value)
+            IDSet is used as the selected IDs as is
 
         inner_join: str
             how to concatenate conditions
 
         """
-        tmp = self._select_any("case_table", "case_id", conditions, inner_join)
+        if isinstance(conditions, IDSet):
+            tmp = conditions
+        else:
+            tmp = self._select_ids("case_table", "case_id", conditions, inner_join)
         if if_exists.lower() == "replace":
             self.case_id = tmp
         elif if_exists.lower() == "and":
@@ -326,8 +1543,10 @@ class Calculator:
 
 
 class Cond2Text:
-    def __init__(self):
-        pass
+    def __init__(self, max_params:int=MAX_PARAMS, filter_keys:tuple=()):
+        self.max_params = max_params # 'in' sets larger than this are given as temp tables
+        # keys whose large sets only filter the records and do not drive the index search
+        self.filter_keys = set(filter_keys)
 
 
     def nested_text(
@@ -381,6 +1600,109 @@ class Cond2Text:
         return f" {inner_join.upper()} ".join(txt)
 
 
+    def nested_query(
+        self, conditions:list, inner_joint:list=[], outer_joint:str="AND", temps:dict=None
+        ):
+        """
+        convert the given conditions to a parameterized query
+
+        Parameters
+        ----------
+        conditions: a list of dict
+            dict {ctype, key, value}
+
+        inner_joint: a list of str
+            indicates each inner condition is concatenated with AND or OR
+            default, AND
+
+        outer_joint: str
+            indicates nested conditions are concatenated with AND or OR
+
+        temps: dict
+            temp tables of the query to be extended, see simple_query
+
+        """
+        assert outer_joint in {"AND", "OR", "and", "or"}
+        if len(inner_joint)==0:
+            inner_joint = ["AND"] * len(conditions)
+        txt = []
+        params = []
+        for c, j in zip(conditions, inner_joint):
+            t, p, temps = self.simple_query(c, j, temps)
+            txt.append(f"({t})")
+            params += p
+        txt = f" {outer_joint.upper()} ".join(txt)
+        return txt, params, temps
+
+
+    def simple_query(self, conditions:list=[], inner_join:str="AND", temps:dict=None):
+        """
+        convert a set of conditions to a parameterized query
+
+        Parameters
+        ----------
+        conditions: a list of dict
+            dict keys (ctype, key, value)
+
+        inner_join: str
+            how to concatenate conditions
+
+        temps: dict
+            temp tables of the query to be extended
+
+        Returns
+        -------
+        txt: str
+            the condition with placeholders
+
+        params: list
+            the values of the placeholders
+
+        temps: dict
+            {temp table name: values}, 'in' sets larger than max_params
+            that should be loaded into temp tables before the query
+
+        """
+        assert inner_join in {"AND", "OR", "and", "or"}
+        if temps is None:
+            temps = dict()
+        txt = []
+        params = []
+        for c in conditions:
+            t, p = self._make_query(c, temps)
+            txt.append(t)
+            params += p
+        return f" {inner_join.upper()} ".join(txt), params, temps
+
+
+    def _make_query(self, condition:dict, temps:dict):
+        """ convert a condition to a parameterized text """
+        # init
+        assert {"ctype", "key", "value"} == set(condition.keys())
+        ctype = condition["ctype"]
+        key = condition["key"]
+        val = condition["value"]
+        # fxn
+        if ctype == "in":
+            if not isinstance(val, IDSet):
+                val = [_to_bind(v) for v in val]
+            if len(val) > self.max_params:
+                name = f"cond_{len(temps)}"
+                temps[name] = val # an IDSet is kept as is for its digest
+                if key.split(".")[-1] in self.filter_keys: # also table.key
+                    key = f"+{key}" # unary plus disqualifies the term from the index
+                return f"{key} IN (SELECT v FROM temp.{name})", []
+            val = val.tolist() if isinstance(val, IDSet) else val
+            return f"{key} IN ({', '.join(['?'] * len(val))})", val
+        op = {
+            "match":"=", "greater":">", "g":">", "greater_equal":">=", "ge":">=",
+            "lower":"<", "l":"<", "lower_equal":"<=", "le":"<=", "equal":"=", "e":"=",
+            }
+        if ctype in op:
+            return f"{key} {op[ctype]} ?", [_to_bind(val)]
+        raise KeyError(f"!! invalid ctype: {ctype} !!")
+
+
     def _make_text(self, condition:dict):
         """ convert a condition to text """
         # init
@@ -413,6 +1735,176 @@ class Cond2Text:
             return f"{key} = {val}"
         raise KeyError # invalid ctype
 
+class SparseCounter():
+    """
+    count cases of all the drug x reaction pairs with sparse incidence matrices
+
+    X_drug: cases x drugs, X_rxn: cases x reactions (CSR, 1 if the case has it)
+    - n11 = X_drug.T @ X_rxn
+    - n1p and np1 are the column sums
+    - npp is the number of cases
+
+    """
+    def __init__(self):
+        self.case_id = np.array([], dtype=np.int64) # labels of the rows
+        self.drug_id = np.array([], dtype=np.int64) # labels of the columns of X_drug
+        self.rxn_id = np.array([], dtype=np.int64) # labels of the columns of X_rxn
+        self.X_drug = None
+        self.X_rxn = None
+        self.rxn_name = "rxn_id" # name of the labels of the columns of X_rxn
+        self.__pairs = {"drug":[], "rxn":[]}
+
+
+    def add(self, records):
+        """
+        add records of drug_rxn_table
+
+        Parameters
+        ----------
+        records: array-like
+            (n, 3) of case_id, drug_id, and rxn_id
+
+        """
+        records = np.asarray(records, dtype=np.int64).reshape(-1, 3)
+        self.__pairs["drug"].append(_unique_pairs(records[:, 0], records[:, 1]))
+        self.__pairs["rxn"].append(_unique_pairs(records[:, 0], records[:, 2]))
+
+
+    def build(self):
+        """ build the incidence matrices from the added records """
+        drug = np.concatenate(self.__pairs["drug"] + [np.zeros((0, 2), dtype=np.int64)])
+        rxn = np.concatenate(self.__pairs["rxn"] + [np.zeros((0, 2), dtype=np.int64)])
+        self.__pairs = {"drug":[], "rxn":[]}
+        self.case_id, case_code = np.unique(
+            np.concatenate([drug[:, 0], rxn[:, 0]]), return_inverse=True
+            )
+        self.drug_id, drug_code = np.unique(drug[:, 1], return_inverse=True)
+        self.rxn_id, rxn_code = np.unique(rxn[:, 1], return_inverse=True)
+        n = len(self.case_id)
+        self.X_drug = _incidence(case_code[:drug.shape[0]], drug_code, (n, len(self.drug_id)))
+        self.X_rxn = _incidence(case_code[drug.shape[0]:], rxn_code, (n, len(self.rxn_id)))
+        return self
+
+
+    def rollup(self, M, labels, name:str):
+        """
+        roll up the reactions to the upper terms
+        X_rxn becomes cases x terms, 1 if the case has any PT under the term,
+        so that a case with several PTs under a term is counted once
+
+        Parameters
+        ----------
+        M: sparse matrix
+            reactions x terms, see MedDRAIndex.membership
+
+        labels: array
+            labels of the terms
+
+        name: str
+            name of the labels such as the layer
+
+        """
+        X = (self.X_rxn @ M).tocsr()
+        X.eliminate_zeros()
+        X.data[:] = 1
+        self.X_rxn = X.astype(np.int32)
+        self.rxn_id = np.asarray(labels)
+        self.rxn_name = name
+        return self
+
+
+    def count(self, min_n11:int=1):
+        """
+        contingency tables of the drug x reaction pairs
+
+        Parameters
+        ----------
+        min_n11: int
+            pairs whose n11 is less than this are not returned, should be 1 or more
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug_id, rxn_id)
+
+        """
+        if min_n11 < 1:
+            raise ValueError("!! min_n11 should be 1 or more !!")
+        n11 = (self.X_drug.T.tocsr() @ self.X_rxn).tocoo()
+        keep = n11.data >= min_n11
+        d, r = n11.row[keep], n11.col[keep]
+        n11 = n11.data[keep].astype(np.int64)
+        n1p = np.asarray(self.X_drug.sum(axis=0), dtype=np.int64).ravel()[d]
+        np1 = np.asarray(self.X_rxn.sum(axis=0), dtype=np.int64).ravel()[r]
+        npp = np.full(len(n11), self.X_drug.shape[0], dtype=np.int64)
+        n2p = npp - n1p
+        n12 = n1p - n11
+        n21 = np1 - n11
+        n22 = n2p - n21
+        np2 = npp - np1
+        result = pd.DataFrame({
+            "n11":n11, "n12":n12, "n1p":n1p, "n21":n21, "n22":n22, "n2p":n2p,
+            "np1":np1, "np2":np2, "npp":npp,
+            }, index=pd.MultiIndex.from_arrays(
+                [self.drug_id[d], self.rxn_id[r]], names=["drug_id", self.rxn_name]
+                ))
+        return result.sort_index()
+
+
+def _temp_key(values):
+    """
+    key of the values loaded into a temp table, the digest of the unique values
+    that of an IDSet such as drug_id and case_id is computed once and kept with it
+
+    """
+    if isinstance(values, IDSet):
+        return values.digest
+    if all(isinstance(v, (int, np.integer)) for v in values):
+        return IDSet(values).digest
+    txt = "\x00".join(sorted(set(map(str, values))))
+    return "str_" + hashlib.blake2b(txt.encode(), digest_size=16).hexdigest()
+
+
+def _to_bind(value):
+    """ numpy scalars such as np.int64 are not bound by sqlite3, converted to python objects """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _long_table(n11, n1p, np1, npp):
+    """ contingency tables from the arrays of n11, n1p, np1, and npp """
+    result = pd.DataFrame({"n11":n11, "n12":n1p - n11, "n1p":n1p})
+    result["n21"] = np1 - n11
+    result["n2p"] = npp - n1p
+    result["n22"] = result["n2p"] - result["n21"]
+    result["np1"] = np1
+    result["np2"] = npp - np1
+    result["npp"] = npp
+    return result[["n11", "n12", "n1p", "n21", "n22", "n2p", "np1", "np2", "npp"]]
+
+
+def _age_labels(age_bins:list):
+    """ {code of the age bin: label}, e.g. [18, 65] gives <18, 18-64, 65+, and unknown """
+    if len(age_bins) == 0:
+        return {-1:"unknown", 0:"all"}
+    labels = {-1:"unknown", 0:f"<{age_bins[0]}", len(age_bins):f"{age_bins[-1]}+"}
+    for i in range(1, len(age_bins)):
+        labels[i] = f"{age_bins[i - 1]}-{age_bins[i] - 1}"
+    return labels
+
+
+def _unique_pairs(a, b):
+    """ unique pairs of the two int arrays as an (n, 2) array """
+    return pd.DataFrame({"a":a, "b":b}).drop_duplicates().values
+
+
+def _incidence(row, col, shape):
+    """ binary CSR matrix of the given positions """
+    X = sparse.csr_matrix(
+        (np.ones(len(row), dtype=np.int32), (row, col)), shape=shape, dtype=np.int32
+        )
+    X.data[:] = 1 # duplicated positions are summed up in the conversion
+    return X
+
+
 class CommonFxn():
     def __init__(self):
         self.ror = np.array([])
@@ -435,11 +1927,25 @@ class CommonFxn():
 
 
     def calc_chi2(self, n11, n12, n21, n22):
-        """ calculate chi-squared values """
-        contingency = np.stack([n11,n12,n21,n22],axis=1)
-        lst_chi = [stats.chi2_contingency(np.reshape(v,(2,2))) for v in contingency]
-        chi = np.array([v[0] for v in lst_chi])
-        p = np.array([v[1] for v in lst_chi])
+        """
+        calculate chi-squared values with Yates' correction
+        same as stats.chi2_contingency for each table, but over the whole arrays
+
+        """
+        observed = np.stack([n11,n12,n21,n22],axis=1).astype(np.float64)
+        n1p = observed[:, 0] + observed[:, 1]
+        n2p = observed[:, 2] + observed[:, 3]
+        np1 = observed[:, 0] + observed[:, 2]
+        np2 = observed[:, 1] + observed[:, 3]
+        npp = observed.sum(axis=1)
+        expected = np.stack([n1p*np1, n1p*np2, n2p*np1, n2p*np2],axis=1) / npp[:, np.newaxis]
+        if np.any(expected == 0):
+            raise ValueError("!! the expected frequencies of some tables have a zero element !!")
+        # Yates' correction, no bigger than the difference
+        diff = expected - observed
+        observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+        chi = ((observed - expected)**2 / expected).sum(axis=1)
+        p = stats.chi2.sf(chi, 1)
         q_bh = multitest.multipletests(p,alpha=0.05,method="fdr_bh")[1]
         q_holm = multitest.multipletests(p,alpha=0.05,method="holm")[1]
         return chi, p, q_bh, q_holm
@@ -447,34 +1953,12 @@ class CommonFxn():
 
     def calc_ic(self, n11, n12, n21, n22):
         """
-        return the IC 95% lower confidence interval signal
+        return the IC lower credibility bound (expectation - 2 SD) of BCPNN
         if the signal > 0, the signal is statistically significant
+        see SignalMetrics.calc_ic
+
         """
-        n1p = n11 + n12
-        n2p = n21 + n22
-        np1 = n11 + n21
-        #np2 = n12 + n22
-        npp = n1p + n2p
-        a1 = 1
-        b1 = 1
-        a = 2
-        b = 2
-        r11 = 1
-        #r12 = 1
-        #r21 = 1
-        #r22 = 1
-        r = r11*(npp+a)*(npp+b) / ((n1p+a1)*(n1p+b1))
-        # calc the IC11 expected value
-        e_deno = (n11+r11)*(npp+a)*(npp+b)
-        e_nume = (npp+r)*(n1p+a1)*(np1+b1)
-        e_ic11 = np.log2(e_deno/e_nume)
-        # calc the variance of IC11
-        tmp = ((npp-n11+r-r11)/((n11+r11)*(1+npp+r)) + (npp-np1+a-a1)/((n1p+a1)*(1+npp+a)) + (npp-np1+b-b1)/((np1+b1)*(1+npp+b)))
-        head = 1/math.log(2)**2
-        v_ic11 = head*tmp
-        # return the signal
-        lower_CI = e_ic11-2*math.sqrt(v_ic11)
-        return lower_CI
+        return SignalMetrics().calc_ic(n11, n12, n21, n22)[1]
 
 
 """
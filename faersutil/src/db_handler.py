@@ -12,13 +12,32 @@ import os
 import datetime
 import sqlite3
 from sqlite3.dbapi2 import OperationalError, ProgrammingError
-from contextlib import closing
+from contextlib import closing, contextmanager, nullcontext
 
 SEP = os.sep
 
+# secondary indexes, {table: [(index name, columns)]}
+# built once after the bulk load
+# drug_rxn_table indexes cover COUNT(DISTINCT case_id) of Calculator:
+# - (drug_id, rxn_id, case_id): n1p and n11 of each drug
+# - (rxn_id, case_id): counts of the reactions
+# - (case_id): joins and deletion with case_table
+INDEX = {
+    "drug_rxn_table":[
+        ("idx_drug_rxn_drug", ["drug_id", "rxn_id", "case_id"]),
+        ("idx_drug_rxn_rxn", ["rxn_id", "case_id"]),
+        ("idx_drug_rxn_case", ["case_id"]),
+        ],
+    }
+
+# PRAGMAs during the bulk load into a new database, the previous ones are restored after it
+BULK_PRAGMA = {"journal_mode":"MEMORY", "synchronous":"OFF"}
+
 class DBhandler():
     def __init__(self):
         self.path = ""
+        self.chunksize = 100000
+        self._conn = None # connection shared in the bulk load
 
 
     def set_path(self, url:str=""):
@@ -35,7 +54,7 @@ class DBhandler():
             des = "description TEXT"
             constraint = f"{hid}, {dat}, {nam}, {des}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE history ({constraint})")
                 conn.commit()
@@ -53,14 +72,13 @@ class DBhandler():
         
         """
         assert len(name) > 0
-        with closing(sqlite3.connect(self.path)) as conn:
+        with self._connect() as conn:
             cur = conn.cursor()
             try:
-                cur.execute(f"SELECT * FROM {name}")
+                cur.execute(f"SELECT * FROM {name} LIMIT {int(n)}")
                 field = [f[0] for f in cur.description]
-                content = cur.fetchall() # list
-                m = len(content)
-                focused = [c for c in content[:min(m, n)]]
+                focused = cur.fetchall() # list
+                m = cur.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
                 tmp = pd.DataFrame(focused, columns=field)
                 print(tmp)                    
                 print(f">> total {m} records in {name}")
@@ -120,7 +138,7 @@ class DBhandler():
             sy = "stored_year REAL"
             constraint = f"{ci}, {se}, {ed}, {ec}, {pa}, {ql}, {sy}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE case_table ({constraint})")
                 conn.commit()
@@ -128,8 +146,7 @@ class DBhandler():
             if_exists = "append"
             done = "newly create"
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
-            df.to_sql("case_table", con=conn, index=False, if_exists=if_exists)
+        self._add_records("case_table", df, if_exists)
         # logging
         desc = f"{done} table"
         self._to_history(target_table="case_table", description=desc)
@@ -183,7 +200,7 @@ class DBhandler():
             soc = "soc TEXT"
             constraint = f"{ui}, {ri}, {pt}, {hlt}, {hlgt}, {soc}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE rxn_table ({constraint})")
                 conn.commit()
@@ -191,8 +208,7 @@ class DBhandler():
             if_exists = "append"
             done = "newly create"            
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
-            df.to_sql("rxn_table", con=conn, index=False, if_exists=if_exists)
+        self._add_records("rxn_table", df, if_exists)
         # logging
         desc = f"{done} table"
         self._to_history(target_table="rxn_table", description=desc)
@@ -243,7 +259,7 @@ class DBhandler():
             rep = "representative INTEGER"
             constraint = f"{dri}, {name}, {did}, {rep}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE drug_dict ({constraint})")
                 conn.commit()
@@ -251,8 +267,7 @@ class DBhandler():
             if_exists = "append"
             done = "newly create"  
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
-            df.to_sql("drug_dict", con=conn, index=False, if_exists=if_exists)
+        self._add_records("drug_dict", df, if_exists)
         # logging
         desc = f"{done} table"
         self._to_history(target_table="drug_dict", description=desc)
@@ -322,7 +337,7 @@ class DBhandler():
             log = "xlogp REAL"
             constraint = f"{did}, {nam}, {cat}, {cid}, {smi}, {iup}, {mfo}, {mwe}, {tps}, {log}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE drug_table ({constraint})")
                 conn.commit()
@@ -331,8 +346,7 @@ class DBhandler():
             # for logging
             done = "newly create"
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
-            df.to_sql("drug_table", con=conn, index=False, if_exists=if_exists)
+        self._add_records("drug_table", df, if_exists)
         # logging
         desc = f"{done} table"
         self._to_history(target_table="drug_table", description=desc)
@@ -384,15 +398,14 @@ class DBhandler():
             rid = "rxn_id INTEGER"
             constraint = f"{dri}, {cid}, {did}, {rid}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE drug_rxn_table ({constraint})")
                 conn.commit()
         # update if_exists
         if_exists = "append"
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
-            df.to_sql("drug_rxn_table", con=conn, index=False, if_exists=if_exists)
+        self._add_records("drug_rxn_table", df, if_exists)
         # no logging because this is mainly subject to loop
 
 
@@ -437,7 +450,7 @@ class DBhandler():
             qna = "qual_name TEXT"
             constraint = f"{qid}, {qna}"
             # prepare table for indicating primary constraint
-            with closing(sqlite3.connect(self.path)) as conn:
+            with self._connect() as conn:
                 cur = conn.cursor()
                 cur.execute(f"CREATE TABLE qualification_table ({constraint})")
                 conn.commit()
@@ -445,20 +458,191 @@ class DBhandler():
         if_exists = "append"
         done = "newly create"
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
-            df.to_sql("qualification_table", con=conn, index=False, if_exists=if_exists)
+        self._add_records("qualification_table", df, if_exists)
         # logging
         desc = f"{done} table"
         self._to_history(target_table="qualification_table", description=desc)
         self.head("qualification_table")
 
 
+    @contextmanager
+    def bulk_load(self, chunksize:int=100000, cache_mb:int=1024):
+        """
+        context manager for building the database with a single connection
+        - records are inserted by chunked executemany in an explicit transaction
+        - for a new or empty drug_rxn_table, journal and sync are relaxed during the load
+          (the build is not durable until the end)
+          and the secondary indexes are dropped and built once after the load
+        - when appending to the existing records, the indexes and the journal are kept
+          so that the deletion by case_id uses the index and a crash does not corrupt the database
+
+        Parameters
+        ----------
+        chunksize: int
+            the number of records passed to executemany at once
+
+        cache_mb: int
+            page cache of the connection in MB
+
+        """
+        assert len(self.path) > 0
+        if self._conn is not None:
+            raise ValueError("!! bulk_load is already active !!")
+        self.chunksize = chunksize
+        conn = sqlite3.connect(self.path, isolation_level=None) # transactions are explicit
+        self._conn = conn
+        new = not self._check_table("drug_rxn_table")
+        if not new:
+            new = conn.execute("SELECT 1 FROM drug_rxn_table LIMIT 1").fetchone() is None
+        prev = {k:conn.execute(f"PRAGMA {k}").fetchone()[0] for k in BULK_PRAGMA}
+        conn.execute(f"PRAGMA cache_size={-int(cache_mb * 1024)}")
+        try:
+            if new:
+                for k, v in BULK_PRAGMA.items():
+                    conn.execute(f"PRAGMA {k}={v}")
+                self.drop_indexes()
+            yield self
+            if new:
+                self.create_indexes()
+        finally:
+            self._conn = None
+            if new:
+                for k, v in prev.items(): # such as WAL set by Calculator
+                    conn.execute(f"PRAGMA {k}={v}")
+            conn.close()
+
+
+    def create_indexes(self, name:str=None):
+        """
+        build the secondary indexes defined in INDEX
+
+        Parameters
+        ----------
+        name: str
+            the table whose indexes are built, all tables if None
+
+        """
+        target = INDEX if name is None else {name:INDEX.get(name, [])}
+        with self._connect() as conn:
+            for t, indexes in target.items():
+                if not self._check_table(t):
+                    continue
+                for idx, col in indexes:
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {idx} ON {t} ({', '.join(col)})")
+                self._to_history(target_table=t, description=f"create {len(indexes)} indexes")
+            conn.commit()
+
+
+    def drop_indexes(self, name:str=None):
+        """
+        drop the secondary indexes defined in INDEX
+
+        Parameters
+        ----------
+        name: str
+            the table whose indexes are dropped, all tables if None
+
+        """
+        target = INDEX if name is None else {name:INDEX.get(name, [])}
+        with self._connect() as conn:
+            for indexes in target.values():
+                for idx, _ in indexes:
+                    conn.execute(f"DROP INDEX IF EXISTS {idx}")
+            conn.commit()
+
+
+    def analyze(self):
+        """ update the statistics used by the query planner """
+        with self._connect() as conn:
+            conn.execute("ANALYZE")
+            conn.commit()
+
+
+    def query_plan(self, order:str, params=()):
+        """
+        the query plan of the order
+
+        Returns
+        -------
+        a list of the details, such as 'SEARCH drug_rxn_table USING COVERING INDEX ...'
+
+        """
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute(f"EXPLAIN QUERY PLAN {order}", params)
+            return [v[3] for v in cur.fetchall()]
+
+
+    def delete_records(self, name:str="", condition:str=""):
+        """
+        delete records of the indicated table
+
+        Parameters
+        ----------
+        name: str
+            the name of the table
+
+        condition: str
+            WHERE clause without "WHERE", all records are deleted if empty
+
+        """
+        assert len(name) > 0
+        if not self._check_table(name):
+            raise KeyError(f"!! {name} does not exist !!")
+        order = f"DELETE FROM {name}"
+        if len(condition) > 0:
+            order += f" WHERE {condition}"
+        with self._connect() as conn:
+            cur = conn.cursor()
+            cur.execute(order)
+            n = cur.rowcount
+            conn.commit()
+        self._to_history(target_table=name, description=f"delete {n} records")
+        return n
+
+
+    def _connect(self):
+        """ the connection of the bulk load if active, otherwise a new one closed after use """
+        if self._conn is not None:
+            return nullcontext(self._conn)
+        return closing(sqlite3.connect(self.path))
+
+
+    def _add_records(self, name:str, df:pd.DataFrame, if_exists:str="append"):
+        """
+        add the records to the table
+        in the bulk load, the records are inserted by executemany keeping the schema
+        and 'replace' deletes the previous records instead of dropping the table
+
+        """
+        if self._conn is None:
+            with closing(sqlite3.connect(self.path)) as conn:
+                df.to_sql(name, con=conn, index=False, if_exists=if_exists)
+            return
+        if if_exists == "fail":
+            raise ValueError(f"!! {name} already exists !!")
+        conn = self._conn
+        order = f"INSERT INTO {name} ({', '.join(df.columns)}) VALUES ({', '.join(['?'] * df.shape[1])})"
+        conn.execute("BEGIN")
+        try:
+            if if_exists == "replace":
+                conn.execute(f"DELETE FROM {name}")
+            for i in range(0, df.shape[0], self.chunksize):
+                chunk = df.iloc[i:i + self.chunksize]
+                # python scalars, NaN is stored as NULL
+                conn.executemany(order, zip(*[chunk[c].tolist() for c in chunk.columns]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
     def _check_table(self, name:str=""):
         """ whether the indicated table exists or not """
-        with closing(sqlite3.connect(self.path)) as conn:
+        with self._connect() as conn:
             cur = conn.cursor()
             try:
-                cur.execute(f'SELECT * FROM {name}')
+                cur.execute(f'SELECT * FROM {name} LIMIT 0')
                 # will fail if the table does not exist
                 flag = True
             except OperationalError:
@@ -472,7 +656,7 @@ class DBhandler():
         
         """
         # add record
-        with closing(sqlite3.connect(self.path)) as conn:
+        with self._connect() as conn:
             now = datetime.datetime.now().strftime('%Y%m%d')
             cur = conn.cursor()
             order = "INSERT INTO history (date, name_table, description) VALUES (?, ?, ?)"
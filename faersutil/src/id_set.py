@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:55:48 2026
+
+compact set of integer IDs such as case_id, drug_id, and rxn_id
+- backed by a sorted unique int64 array, 8 bytes for each ID
+- and/or/andnot are vectorized with np.isin, which uses a dense lookup table
+  (bitmap like) when the range of the IDs is compact
+- combined with python sets as well, e.g. {1, 2} & IDSet([2, 3])
+
+@author: tadahaya
+"""
+
+import hashlib
+import numpy as np
+
+class IDSet():
+    def __init__(self, values=(), is_sorted:bool=False):
+        """
+        Parameters
+        ----------
+        values: iterable of int, np.ndarray, or IDSet
+
+        is_sorted: bool
+            whether the values are already sorted and unique, which skips np.unique
+
+        """
+        self._digest = None # computed at the first use, see digest
+        if isinstance(values, IDSet):
+            self.values = values.values
+            self._digest = values._digest
+            return
+        if isinstance(values, (set, frozenset)):
+            values = np.fromiter(values, dtype=np.int64, count=len(values))
+        arr = np.asarray(values, dtype=np.int64).ravel()
+        if not is_sorted:
+            arr = np.unique(arr)
+        self.values = arr
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __iter__(self):
+        # python ints so that the IDs can be bound to sqlite as is
+        return iter(self.values.tolist())
+
+
+    def __contains__(self, item):
+        i = np.searchsorted(self.values, item)
+        return bool((i < len(self.values)) and (self.values[i] == item))
+
+
+    def __eq__(self, other):
+        other = _as_idset(other)
+        if other is NotImplemented:
+            return other
+        return np.array_equal(self.values, other.values)
+
+
+    __hash__ = None
+
+
+    def __repr__(self):
+        return f"IDSet(n={len(self.values)}, nbytes={self.nbytes})"
+
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+
+    @property
+    def digest(self):
+        """ blake2b digest of the IDs, computed once, which identifies the set without collision in practice """
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.values.tobytes(), digest_size=16).hexdigest()
+        return self._digest
+
+
+    def tolist(self):
+        """ sorted list of python ints """
+        return self.values.tolist()
+
+
+    def and_(self, other):
+        """ intersection """
+        other = IDSet(other)
+        mask = np.isin(self.values, other.values, assume_unique=True)
+        return IDSet(self.values[mask], is_sorted=True)
+
+
+    def or_(self, other):
+        """ union """
+        other = IDSet(other)
+        return IDSet(np.union1d(self.values, other.values), is_sorted=True)
+
+
+    def andnot(self, other):
+        """ difference """
+        other = IDSet(other)
+        mask = np.isin(self.values, other.values, assume_unique=True, invert=True)
+        return IDSet(self.values[mask], is_sorted=True)
+
+
+    def __and__(self, other):
+        other = _as_idset(other)
+        return other if other is NotImplemented else self.and_(other)
+
+
+    def __or__(self, other):
+        other = _as_idset(other)
+        return other if other is NotImplemented else self.or_(other)
+
+
+    def __sub__(self, other):
+        other = _as_idset(other)
+        return other if other is NotImplemented else self.andnot(other)
+
+
+    def __rand__(self, other):
+        return self.__and__(other)
+
+
+    def __ror__(self, other):
+        return self.__or__(other)
+
+
+    def __rsub__(self, other):
+        other = _as_idset(other)
+        return other if other is NotImplemented else other.andnot(self)
+
+
+def _as_idset(value):
+    """ IDSet of the operand or NotImplemented """
+    if isinstance(value, IDSet):
+        return value
+    if isinstance(value, (set, frozenset, list, tuple, np.ndarray)):
+        return IDSet(value)
+    return NotImplemented
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:10:37 2026
+
+drug-drug interaction screening over the triplets of (drug A, drug B, reaction)
+counted with the sparse incidence matrices of SparseCounter
+
+### counts of a triplet ###
+                        with reaction    cases
+both A and B                n111          n11
+A without B                 n101          n10
+B without A                 n011          n01
+neither                     n001          n00
+
+@author: tadahaya
+"""
+
+import numpy as np
+import pandas as pd
+
+class Interaction():
+    def __init__(self, alpha:float=0.5):
+        self.alpha = alpha # shrinkage of omega
+
+
+    def count(self, counter, min_support:int=3, min_n111:int=1, max_nnz:int=50000000):
+        """
+        count the triplets of the co-reported drug pairs and the reactions
+
+        Parameters
+        ----------
+        counter: SparseCounter
+            built with the records of drug_rxn_table
+
+        min_support: int
+            drug pairs reported together in less than this number of cases are not counted
+
+        min_n111: int
+            triplets whose n111 is less than this are not returned, should be 1 or more
+
+        max_nnz: int
+            the upper bound of the nonzero elements of the case x pair matrix at once
+
+        Returns
+        -------
+        pd.DataFrame indexed by (drug_a, drug_b, rxn_id) with the counts above
+
+        """
+        if min_n111 < 1:
+            raise ValueError("!! min_n111 should be 1 or more !!")
+        X = counter.X_drug.tocsc()
+        Xr = counter.X_rxn.tocsr()
+        npp = X.shape[0]
+        n_drug = np.asarray(X.sum(axis=0), dtype=np.int64).ravel()
+        n_rxn = np.asarray(Xr.sum(axis=0), dtype=np.int64).ravel()
+        drug_rxn = (X.T.tocsr() @ Xr).tocsr() # n11 of each drug x reaction
+        # 1. co-reported pairs
+        pair = (X.T.tocsr() @ X).tocoo()
+        keep = (pair.row < pair.col) & (pair.data >= min_support)
+        I, J = pair.row[keep], pair.col[keep]
+        support = pair.data[keep].astype(np.int64)
+        # 2. triplets, case x pair matrix by chunk
+        res = []
+        cost = np.cumsum(n_drug[I] + n_drug[J])
+        start = 0
+        while start < len(I):
+            base = cost[start - 1] if start > 0 else 0
+            end = max(np.searchsorted(cost, base + max_nnz, side="right"), start + 1)
+            i, j = I[start:end], J[start:end]
+            P = X[:, i].multiply(X[:, j]).tocsc() # 1 if the case has both
+            T = (P.T.tocsr() @ Xr).tocoo()
+            keep = T.data >= min_n111
+            p, r = T.row[keep], T.col[keep]
+            res.append((i[p], j[p], r, T.data[keep].astype(np.int64), support[start:end][p]))
+            start = end
+        a, b, r, n111, n11 = [
+            np.concatenate([v[k] for v in res] + [np.array([], dtype=np.int64)]) for k in range(5)
+            ]
+        a, b, r = a.astype(np.int64), b.astype(np.int64), r.astype(np.int64)
+        # 3. the other cells
+        na = np.asarray(drug_rxn[a, r], dtype=np.int64).ravel()
+        nb = np.asarray(drug_rxn[b, r], dtype=np.int64).ravel()
+        result = pd.DataFrame({
+            "n111":n111, "n11":n11,
+            "n101":na - n111, "n10":n_drug[a] - n11,
+            "n011":nb - n111, "n01":n_drug[b] - n11,
+            "n001":n_rxn[r] - na - nb + n111, "n00":npp - n_drug[a] - n_drug[b] + n11,
+            }, index=pd.MultiIndex.from_arrays(
+                [counter.drug_id[a], counter.drug_id[b], counter.rxn_id[r]],
+                names=["drug_a", "drug_b", "rxn_id"]
+                ))
+        return result.sort_index()
+
+
+    def calc_score(self, table:pd.DataFrame):
+        """
+        calculate the interaction scores of the triplets
+        - omega: shrunk observed-to-expected ratio of Noren et al. (2008) in log2,
+          whose expectation is given by the additive model on the odds scale, and its lower bound
+        - RERI: relative excess risk due to interaction, additive scale
+        - multiplicative: RR11 / (RR10 * RR01)
+        the risks are relative to the cases with neither drug
+
+        Parameters
+        ----------
+        table: pd.DataFrame
+            the output of count
+
+        """
+        n111, n11, n101, n10, n011, n01, n001, n00 = [
+            table[k].values.astype(np.float64) for k in ["n111", "n11", "n101", "n10", "n011", "n01", "n001", "n00"]
+            ]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f11, f10, f01, f00 = n111/n11, n101/n10, n011/n01, n001/n00
+            o00 = f00/(1 - f00)
+            # a drug without any case alone takes the baseline odds
+            g11 = 1 - 1/(np.fmax(o00, f10/(1 - f10)) + np.fmax(o00, f01/(1 - f01)) - o00 + 1)
+            e111 = g11*n11
+            omega = np.log2((n111 + self.alpha)/(e111 + self.alpha))
+            lower = omega - 3.3*(n111 + self.alpha)**(-1/2) - 2*(n111 + self.alpha)**(-3/2)
+            rr11, rr10, rr01 = f11/f00, f10/f00, f01/f00
+            reri = rr11 - rr10 - rr01 + 1
+            mult = rr11/(rr10*rr01)
+        table = table.copy()
+        table.loc[:, "E111"] = e111
+        table.loc[:, "omega"] = omega
+        table.loc[:, "omega025"] = lower
+        table.loc[:, "RERI"] = reri
+        table.loc[:, "multiplicative"] = mult
+        return table.sort_values("omega025", ascending=False)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:12:40 2026
+
+handle the intermediate files passed between the stages
+- parsed: parsed_{key}_{i}, output of xml_loader
+- clean: clean_{date}, output of clean_and_merge
+- drug_rxn: drug_rxn_{stored_year}_{date}, output of prep_drug_rxn
+
+tsv (.txt) and parquet (.parquet) are available
+parquet requires pyarrow (optional)
+
+@author: tadahaya
+"""
+
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+FORMAT = ["tsv", "parquet"]
+EXT = {"tsv":".txt", "parquet":".parquet"}
+
+# typed schemas of the stages
+SCHEMA = {
+    "parsed":{
+        "Case ID":"int64", "Active Substances":"object", "Reactions":"object",
+        "Sex":"object", "Event Date":"float64", "Event Country":"object",
+        "Patient Age":"float64", "Qualification":"object",
+        },
+    "clean":{
+        "case_id":"int64", "active_substances":"object", "reactions":"object",
+        "sex":"object", "event_date":"int64", "event_country":"object",
+        "patient_age":"int64", "qualification":"int64", "stored_year":"float64",
+        },
+    "drug_rxn":{
+        "active_substances":"int64", "reactions":"int64", "case_id":"int64",
+        "stored_year":"float64",
+        },
+    }
+
+# whether the tsv of the stage has the index column
+INDEX = {"parsed":False, "clean":True, "drug_rxn":True}
+
+
+def get_format(url:str):
+    """ infer the format from the extension """
+    for k, v in EXT.items():
+        if url.endswith(v):
+            return k
+    raise ValueError(f"!! Unknown format: {url} !!")
+
+
+def glob_table(pattern:str):
+    """ glob the files of the pattern (without extension) in any format """
+    res = []
+    for v in EXT.values():
+        res += glob.glob(pattern + v)
+    return res
+
+
+def write_table(df:pd.DataFrame, fileout:str, stage:str, fmt:str="tsv"):
+    """
+    export the table of the indicated stage
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        the table to be exported
+
+    fileout: str
+        the output path whose extension should correspond to fmt
+
+    stage: str
+        parsed, clean, or drug_rxn
+
+    fmt: str
+        tsv or parquet
+
+    """
+    _check(stage, fmt)
+    if fmt == "tsv":
+        df.to_csv(fileout, sep="\t", index=INDEX[stage])
+    else:
+        df = _apply_schema(df, stage)
+        df.to_parquet(fileout, engine="pyarrow", index=False)
+
+
+def write_chunks(chunks, fileout:str, stage:str, fmt:str="tsv"):
+    """
+    export the tables given as an iterator chunk by chunk
+    the partially written file is removed when an error occurs
+
+    """
+    _check(stage, fmt)
+    writer = None
+    first = True
+    try:
+        for df in chunks:
+            if fmt == "tsv":
+                df.to_csv(
+                    fileout, sep="\t", index=INDEX[stage], mode="w" if first else "a",
+                    header=first
+                    )
+            else:
+                table = pa.Table.from_pandas(_apply_schema(df, stage), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(fileout, table.schema)
+                writer.write_table(table)
+            first = False
+        if writer is not None:
+            writer.close()
+    except Exception:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(fileout):
+            os.remove(fileout)
+        raise
+
+
+def read_table(
+        url:str, stage:str, columns:list=None, filters:list=None, dtype:dict=None
+        ):
+    """
+    load the table of the indicated stage
+
+    Parameters
+    ----------
+    url: str
+        the path of the table, whose format is inferred from the extension
+
+    stage: str
+        parsed, clean, or drug_rxn
+
+    columns: list
+        the columns to be loaded, all if None
+
+    filters: list
+        a list of (column, op, value) combined with AND, such as [("stored_year", "==", 2015.1)]
+        pushed down to the parquet reader, applied after loading for tsv
+
+    dtype: dict
+        dtype passed to pd.read_csv for tsv
+
+    """
+    fmt = get_format(url)
+    _check(stage, fmt)
+    if fmt == "tsv":
+        index_col = 0 if INDEX[stage] else None
+        df = pd.read_csv(url, sep="\t", index_col=index_col, dtype=dtype)
+        if filters is not None:
+            mask = np.ones(df.shape[0], dtype=bool)
+            for k, op, v in filters:
+                mask &= _compare(df[k], op, v)
+            df = df[mask]
+        if columns is not None:
+            df = df[columns]
+    else:
+        df = pq.read_table(url, columns=columns, filters=filters).to_pandas()
+        # missing values as np.nan, same as pd.read_csv
+        for c in df.columns:
+            if df[c].dtype == object:
+                tmp = df[c].to_numpy(dtype=object, copy=True)
+                tmp[pd.isna(tmp)] = np.nan
+                df[c] = tmp
+    return df
+
+
+def _check(stage:str, fmt:str):
+    """ check the stage and the format """
+    if stage not in SCHEMA:
+        raise KeyError(f"!! stage should be chosen from {list(SCHEMA.keys())} !!")
+    if fmt not in FORMAT:
+        raise KeyError(f"!! fmt should be chosen from {FORMAT} !!")
+    if (fmt == "parquet") & (pa is None):
+        raise ImportError("!! parquet requires pyarrow: pip install pyarrow !!")
+
+
+def _apply_schema(df:pd.DataFrame, stage:str):
+    """ cast the columns based on the schema, empty str is regarded as missing """
+    df = df.copy()
+    for c, t in SCHEMA[stage].items():
+        if c not in df.columns:
+            continue
+        if t == "object":
+            s = df[c].astype(object)
+            df[c] = s.where(s.notna() & (s != ""), None)
+        else:
+            s = df[c].replace("", np.nan) if df[c].dtype == object else df[c]
+            df[c] = pd.to_numeric(s).astype(t)
+    return df
+
+
+def _compare(s:pd.Series, op:str, v):
+    """ element-wise comparison for filters """
+    if op in {"==", "="}:
+        return (s == v).values
+    if op == "!=":
+        return (s != v).values
+    if op == ">":
+        return (s > v).values
+    if op == ">=":
+        return (s >= v).values
+    if op == "<":
+        return (s < v).values
+    if op == "<=":
+        return (s <= v).values
+    if op == "in":
+        return s.isin(v).values
+    raise KeyError(f"!! invalid op: {op} !!")
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:05:12 2026
+
+manifest of the processed inputs for incremental ingestion
+a tsv in workdir that records the following fields:
+- stage: parse, clean, drug_rxn, database, etc.
+- key: identifier of the input in the stage, such as the path of a xml file or a stored_year
+- hash: hash of the input
+- output: path of the output
+- date: YYYYMMDD of the processing
+
+@author: tadahaya
+"""
+
+import os
+import datetime
+import hashlib
+import pandas as pd
+
+SEP = os.sep
+
+FIELD = ["stage", "key", "hash", "output", "date"]
+
+class Manifest():
+    def __init__(self, url:str=""):
+        self.url = url
+        self.records = dict() # {(stage, key): (hash, output, date)}
+        if len(url) > 0:
+            self.load(url)
+
+
+    def load(self, url:str):
+        """ load the manifest if it exists """
+        self.url = url
+        self.records = dict()
+        if os.path.exists(url):
+            df = pd.read_csv(url, sep="\t", dtype=str, keep_default_na=False)
+            for v in df[FIELD].values:
+                self.records[(v[0], v[1])] = (v[2], v[3], v[4])
+
+
+    def save(self):
+        """ export the manifest """
+        assert len(self.url) > 0
+        res = [list(k) + list(v) for k, v in self.records.items()]
+        df = pd.DataFrame(res, columns=FIELD)
+        df.to_csv(self.url, sep="\t", index=False)
+
+
+    def check(self, stage:str, key:str, hash:str):
+        """ whether the input has been processed with the same hash and its output remains """
+        rec = self.records.get((stage, key))
+        if rec is None:
+            return False
+        return (rec[0] == hash) & os.path.exists(rec[1])
+
+
+    def get_output(self, stage:str, key:str):
+        """ the recorded output or None """
+        rec = self.records.get((stage, key))
+        if rec is None:
+            return None
+        return rec[1]
+
+
+    def get_keys(self, stage:str):
+        """ the recorded keys of the stage """
+        return [k[1] for k in self.records.keys() if k[0] == stage]
+
+
+    def update(self, stage:str, key:str, hash:str, output:str, save:bool=True):
+        """ record the processed input """
+        now = datetime.datetime.now().strftime('%Y%m%d')
+        self.records[(stage, key)] = (hash, output, now)
+        if save:
+            self.save()
+
+
+    def remove(self, stage:str, key:str, save:bool=True):
+        """ delete the record """
+        self.records.pop((stage, key), None)
+        if save:
+            self.save()
+
+
+def file_hash(url:str, chunksize:int=2**24):
+    """ sha1 of the file contents """
+    h = hashlib.sha1()
+    with open(url, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def frame_hash(df:pd.DataFrame):
+    """ sha1 of the values of the dataframe (index is ignored) """
+    tmp = pd.util.hash_pandas_object(df, index=False).values
+    return hashlib.sha1(tmp.tobytes()).hexdigest()
+
+
+def concat_hash(hashes:list):
+    """ combine the hashes into one """
+    return hashlib.sha1("".join(hashes).encode()).hexdigest()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:44 2026
+
+in-memory index of the MedDRA hierarchy in rxn_table
+- each layer (pt, hlt, hlgt, soc) has the sorted unique terms and
+  the rxn_id of the PTs under each term in CSR form (indptr, rxn_id)
+- the PTs under a term are a slice, O(result)
+- prefix search is a binary search on the sorted terms
+- a PT can belong to several upper terms (multiaxial)
+
+@author: tadahaya
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .id_set import IDSet
+
+LAYERS = ["pt", "hlt", "hlgt", "soc"]
+
+class MedDRAIndex():
+    def __init__(self, df:pd.DataFrame):
+        """
+        Parameters
+        ----------
+        df: pd.DataFrame
+            records of rxn_table with rxn_id and the layers
+
+        """
+        self.terms = dict() # {layer: sorted unique terms}
+        self.indptr = dict() # {layer: offsets of the terms in rxn_id}
+        self.rxn_id = dict() # {layer: rxn_id sorted by term}
+        self.__code = dict() # {layer: {term: code}}
+        for k in LAYERS:
+            tmp = df[["rxn_id", k]].dropna().drop_duplicates()
+            terms, code = np.unique(tmp[k].values.astype(str), return_inverse=True)
+            order = np.lexsort((tmp["rxn_id"].values, code))
+            self.terms[k] = terms
+            self.indptr[k] = np.concatenate([[0], np.cumsum(np.bincount(code, minlength=len(terms)))])
+            self.rxn_id[k] = tmp["rxn_id"].values[order].astype(np.int64)
+            self.__code[k] = {v:i for i, v in enumerate(terms)}
+
+
+    def get(self, term:str, layer:str="soc"):
+        """ rxn_id of the PTs under the term as a sorted array, empty if unknown """
+        i = self.__code[layer].get(term)
+        if i is None:
+            return np.array([], dtype=np.int64)
+        return self.rxn_id[layer][self.indptr[layer][i]:self.indptr[layer][i + 1]]
+
+
+    def search(self, prefix:str, layer:str="soc"):
+        """ the terms starting with the prefix """
+        terms = self.terms[layer]
+        lo = np.searchsorted(terms, prefix, side="left")
+        hi = np.searchsorted(terms, prefix + "\U0010ffff", side="left")
+        return terms[lo:hi]
+
+
+    def select(self, terms, layer:str="soc"):
+        """
+        rxn_id of the PTs under any of the terms
+
+        Parameters
+        ----------
+        terms: list or dict
+            terms in the layer, those ending with '*' are prefixes
+            {layer: terms} expands the terms of several layers at once
+
+        Returns
+        -------
+        IDSet of rxn_id and the list of the unknown terms
+
+        """
+        if not isinstance(terms, dict):
+            terms = {layer:terms}
+        res = [np.array([], dtype=np.int64)]
+        unknown = []
+        for k, v in terms.items():
+            if k not in LAYERS:
+                raise KeyError(f"!! layer should be chosen from {LAYERS} !!")
+            for t in v:
+                if t.endswith("*"):
+                    found = self.search(t[:-1], k)
+                    res += [self.get(f, k) for f in found]
+                else:
+                    found = [t] if t in self.__code[k] else []
+                    res.append(self.get(t, k))
+                if len(found) == 0:
+                    unknown.append(t)
+        return IDSet(np.concatenate(res)), unknown
+
+
+    def membership(self, rxn_id, layer:str="soc"):
+        """
+        sparse matrix of the PTs x the terms of the layer, 1 if the PT is under the term
+        X_rxn @ membership gives the cases x terms, see SparseCounter.rollup
+
+        Parameters
+        ----------
+        rxn_id: array
+            sorted rxn_id of the rows
+
+        Returns
+        -------
+        CSR matrix and the terms of the columns
+
+        """
+        rxn_id = np.asarray(rxn_id, dtype=np.int64)
+        code = np.repeat(np.arange(len(self.terms[layer])), np.diff(self.indptr[layer]))
+        row = np.searchsorted(rxn_id, self.rxn_id[layer])
+        if len(rxn_id) > 0:
+            row = np.minimum(row, len(rxn_id) - 1)
+            found = rxn_id[row] == self.rxn_id[layer]
+        else:
+            found = np.zeros(len(row), dtype=bool)
+        M = sparse.csr_matrix(
+            (np.ones(found.sum(), dtype=np.int32), (row[found], code[found])),
+            shape=(len(rxn_id), len(self.terms[layer]))
+            )
+        return M, self.terms[layer]
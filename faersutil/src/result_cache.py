@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:42:31 2026
+
+on-disk cache of the results of Calculator
+- entries are pickles in a directory for each database
+- the file name of an entry is {fingerprint of the database}_{hash of the arguments}.pkl
+- entries of an older fingerprint are never hit and are removed when the new one is stored
+- the least recently used entries are evicted when the total size exceeds the limit
+
+@author: tadahaya
+"""
+
+import os
+import glob
+import json
+import pickle
+import sqlite3
+import hashlib
+from pathlib import Path
+from contextlib import closing
+import numpy as np
+
+SEP = os.sep
+
+class ResultCache():
+    def __init__(self, cache_dir:str, max_mb:float=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 2**20)
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def make_key(self, db_path:str, **kwargs):
+        """
+        the key of the entry, (directory of the database, fingerprint, hash of the arguments)
+        lists, tuples, and sets are sorted so that their order does not matter
+
+        """
+        canon = {k:_canonical(v) for k, v in kwargs.items()}
+        txt = json.dumps(canon, sort_keys=True, separators=(",", ":"))
+        args_hash = hashlib.sha1(txt.encode()).hexdigest()
+        db_dir = hashlib.sha1(os.path.abspath(db_path).encode()).hexdigest()[:16]
+        return (db_dir, db_fingerprint(db_path), args_hash)
+
+
+    def get(self, key:tuple):
+        """ the cached object or None """
+        url = self._url(key)
+        try:
+            with open(url, "rb") as f:
+                obj = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(url) # mark as recently used
+        return obj
+
+
+    def put(self, key:tuple, obj):
+        """ store the object and evict the stale and the least recently used entries """
+        url = self._url(key)
+        os.makedirs(os.path.dirname(url), exist_ok=True)
+        tmp = url + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, url) # atomic
+        # entries of the older versions of the database
+        for v in glob.glob(self.cache_dir + SEP + key[0] + SEP + "*.pkl"):
+            if not os.path.basename(v).startswith(key[1] + "_"):
+                os.remove(v)
+        self._evict()
+
+
+    def invalidate(self, db_path:str=None):
+        """ remove the entries of the database, or all the entries if db_path is None """
+        if db_path is None:
+            pattern = self.cache_dir + SEP + "*" + SEP + "*.pkl"
+        else:
+            db_dir = hashlib.sha1(os.path.abspath(db_path).encode()).hexdigest()[:16]
+            pattern = self.cache_dir + SEP + db_dir + SEP + "*.pkl"
+        n = 0
+        for v in glob.glob(pattern):
+            os.remove(v)
+            n += 1
+        return n
+
+
+    def size(self):
+        """ total bytes of the entries """
+        return sum([os.path.getsize(v) for v in glob.glob(self.cache_dir + SEP + "*" + SEP + "*.pkl")])
+
+
+    def _evict(self):
+        """ remove the least recently used entries until the total size is within the limit """
+        entries = []
+        for v in glob.glob(self.cache_dir + SEP + "*" + SEP + "*.pkl"):
+            st = os.stat(v)
+            entries.append((st.st_mtime, st.st_size, v))
+        total = sum([e[1] for e in entries])
+        for mtime, size, url in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(url)
+            total -= size
+
+
+    def _url(self, key:tuple):
+        return self.cache_dir + SEP + key[0] + SEP + f"{key[1]}_{key[2]}.pkl"
+
+
+def db_fingerprint(db_path:str):
+    """
+    fingerprint of the database
+    the last record of the history table and the size and mtime of the file
+    the WAL is not included, which changes by checkpoints without any change of the data
+
+    """
+    res = []
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    with closing(sqlite3.connect(uri, uri=True)) as conn:
+        try:
+            res.append(conn.execute("SELECT MAX(history_id), COUNT(*) FROM history").fetchone())
+        except sqlite3.OperationalError: # no history table
+            res.append(None)
+    st = os.stat(db_path)
+    res.append((st.st_size, st.st_mtime_ns))
+    return hashlib.sha1(repr(res).encode()).hexdigest()[:16]
+
+
+def _canonical(value):
+    """ json serializable form of the argument """
+    if isinstance(value, (list, tuple, set, frozenset, np.ndarray)):
+        value = list(value)
+        if len(value) > 100:
+            # large ID sets such as the preprocessed cases are summarized by hash
+            arr = np.asarray(value)
+            if arr.dtype.kind in "iu":
+                return hashlib.sha1(np.sort(arr.astype(np.int64)).tobytes()).hexdigest()
+        return sorted([_canonical(v) for v in value], key=repr)
+    if isinstance(value, dict):
+        return {str(k):_canonical(v) for k, v in value.items()}
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, str):
+        return value.lower()
+    return value
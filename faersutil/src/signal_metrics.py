@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:20:05 2026
+
+signal metrics of disproportionality over arrays of 2x2 tables
+- IC: information component of BCPNN with its credibility interval
+- PRR: proportional reporting ratio with its confidence interval
+- EBGM: empirical Bayes geometric mean of MGPS with EB05 and EB95
+- MH: Mantel-Haenszel ROR pooled over strata with its confidence interval
+
+### contingency table ###
+                    focusing adverse effect  not focusing AE     sum
+
+focusing drug                 n11                n12             n1p
+
+not focusing drug             n21                n22             n2p
+
+sum                           np1                np2             npp
+
+@author: tadahaya
+"""
+
+import warnings
+import numpy as np
+from scipy import optimize, special
+
+# initial values of the MGPS prior (DuMouchel, 1999)
+PRIOR = {"alpha1":0.2, "beta1":0.1, "alpha2":2.0, "beta2":4.0, "p":1/3}
+
+# the prior is fitted to at least this number of pairs with the expected count
+MIN_PAIRS = 100
+
+# bounds of log(alpha) and log(beta) in the fit
+LOG_BOUND = 10
+
+class SignalMetrics():
+    def __init__(self):
+        self.prior = dict() # fitted prior of MGPS
+
+
+    def calc_ic(self, n11, n12, n21, n22):
+        """
+        calculate IC of BCPNN (Bate et al., 1998)
+        the priors are a1 = b1 = 1, a = b = 2, and r11 = 1
+
+        Returns
+        -------
+        IC (expectation), and its lower and upper bounds (expectation -/+ 2 SD)
+
+        """
+        n11, n1p, np1, npp = _margins(n11, n12, n21, n22)
+        a1 = b1 = 1
+        a = b = 2
+        r11 = 1
+        r = r11*(npp + a)*(npp + b) / ((n1p + a1)*(np1 + b1))
+        ic = np.log2(((n11 + r11)*(npp + a)*(npp + b)) / ((npp + r)*(n1p + a1)*(np1 + b1)))
+        v = (npp - n11 + r - r11) / ((n11 + r11)*(1 + npp + r))
+        v += (npp - n1p + a - a1) / ((n1p + a1)*(1 + npp + a))
+        v += (npp - np1 + b - b1) / ((np1 + b1)*(1 + npp + b))
+        sd = np.sqrt(v) / np.log(2)
+        return ic, ic - 2*sd, ic + 2*sd
+
+
+    def calc_prr(self, n11, n12, n21, n22):
+        """
+        calculate PRR and its 95% confidence interval
+
+        Returns
+        -------
+        PRR, and its lower and upper CI
+
+        """
+        n11, n1p, np1, npp = _margins(n11, n12, n21, n22)
+        n21 = np.asarray(n21, dtype=np.float64)
+        n2p = npp - n1p
+        with np.errstate(divide="ignore", invalid="ignore"):
+            prr = (n11/n1p) / (n21/n2p)
+            se = np.sqrt(1/n11 - 1/n1p + 1/n21 - 1/n2p)
+            lower = np.exp(np.log(prr) - 1.96*se)
+            upper = np.exp(np.log(prr) + 1.96*se)
+        return prr, lower, upper
+
+
+    def calc_mh(self, n11, n12, n21, n22, groups):
+        """
+        calculate the Mantel-Haenszel ROR pooled over the strata of each group
+        and its 95% CI with the variance of Robins, Breslow, and Greenland (1986)
+
+        Parameters
+        ----------
+        groups: array
+            integer codes (0, 1, ...) of the pooled unit of each table, such as the drug
+
+        Returns
+        -------
+        ROR_MH, and its lower and upper CI for each code
+
+        """
+        a, b, c, d = [np.asarray(v, dtype=np.float64) for v in [n11, n12, n21, n22]]
+        groups = np.asarray(groups)
+        n = a + b + c + d
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # empty strata do not contribute
+            r = np.where(n > 0, a*d/n, 0)
+            s = np.where(n > 0, b*c/n, 0)
+            p = np.where(n > 0, (a + d)/n, 0)
+            q = np.where(n > 0, (b + c)/n, 0)
+            def total(x):
+                return np.bincount(groups, weights=x)
+            sr, ss = total(r), total(s)
+            ror = sr/ss
+            var = total(p*r)/(2*sr**2) + total(p*s + q*r)/(2*sr*ss) + total(q*s)/(2*ss**2)
+            se = np.sqrt(var)
+            lower = np.exp(np.log(ror) - 1.96*se)
+            upper = np.exp(np.log(ror) + 1.96*se)
+        return ror, lower, upper
+
+
+    def fit_prior(self, n11, e11, max_iter:int=200, tol:float=1e-6):
+        """
+        fit the prior of MGPS, a mixture of two gammas, by EM over all the pairs
+        the pairs should cover many drugs and reactions such as the output of make_pair_table,
+        the fit is not identifiable with a few pairs
+
+        Parameters
+        ----------
+        n11: array
+            observed counts
+
+        e11: array
+            expected counts, n1p * np1 / npp
+
+        max_iter: int
+            the maximum number of EM iterations
+
+        tol: float
+            stop when the improvement of the log likelihood per pair is less than this
+
+        """
+        n11 = np.asarray(n11, dtype=np.float64)
+        e11 = np.asarray(e11, dtype=np.float64)
+        valid = e11 > 0
+        n11, e11 = n11[valid], e11[valid]
+        if len(n11) < MIN_PAIRS:
+            raise ValueError(
+                f"!! {len(n11)} pairs are too few to fit the prior (at least {MIN_PAIRS}): give a prior fitted to a larger table !!"
+                )
+        theta = dict(PRIOR)
+        prev = -np.inf
+        for i in range(max_iter):
+            # E-step
+            f1 = _log_nbinom(n11, e11, theta["alpha1"], theta["beta1"])
+            f2 = _log_nbinom(n11, e11, theta["alpha2"], theta["beta2"])
+            q, ll = _responsibility(f1, f2, theta["p"])
+            ll = ll / len(n11)
+            if ll - prev < tol:
+                break
+            prev = ll
+            # M-step
+            theta["p"] = np.clip(q.mean(), 1e-6, 1 - 1e-6)
+            theta["alpha1"], theta["beta1"] = _fit_gamma(n11, e11, q, theta["alpha1"], theta["beta1"])
+            theta["alpha2"], theta["beta2"] = _fit_gamma(n11, e11, 1 - q, theta["alpha2"], theta["beta2"])
+        at_bound = [
+            k for k in ["alpha1", "beta1", "alpha2", "beta2"]
+            if abs(np.log(theta[k])) > LOG_BOUND - 1e-3
+            ]
+        if len(at_bound) > 0:
+            warnings.warn(f"!! {at_bound} of the prior reached the bound of the fit, EBGM is unreliable !!")
+        self.prior = theta
+        return theta
+
+
+    def calc_ebgm(self, n11, n12, n21, n22, prior:dict=None):
+        """
+        calculate EBGM of MGPS (DuMouchel, 1999) and its 5% and 95% posterior quantiles
+        the prior is fitted to the given tables if not given
+
+        Returns
+        -------
+        EBGM, EB05, and EB95
+
+        """
+        n11, n1p, np1, npp = _margins(n11, n12, n21, n22)
+        e11 = n1p*np1/npp
+        if prior is None:
+            prior = self.fit_prior(n11, e11)
+        a1, b1, a2, b2 = prior["alpha1"], prior["beta1"], prior["alpha2"], prior["beta2"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f1 = _log_nbinom(n11, e11, a1, b1)
+            f2 = _log_nbinom(n11, e11, a2, b2)
+            q, _ = _responsibility(f1, f2, prior["p"])
+            # posterior: q * gamma(a1 + n11, b1 + e11) + (1 - q) * gamma(a2 + n11, b2 + e11)
+            shape = (a1 + n11, a2 + n11)
+            rate = (b1 + e11, b2 + e11)
+            eblog = q*(special.digamma(shape[0]) - np.log(rate[0]))
+            eblog += (1 - q)*(special.digamma(shape[1]) - np.log(rate[1]))
+            ebgm = np.exp(eblog)
+            eb05 = _mixture_quantile(0.05, q, shape, rate)
+            eb95 = _mixture_quantile(0.95, q, shape, rate)
+        # undefined without the expected count
+        for v in [ebgm, eb05, eb95]:
+            v[~(e11 > 0)] = np.nan
+        return ebgm, eb05, eb95
+
+
+def _margins(n11, n12, n21, n22):
+    """ float arrays of n11, n1p, np1, and npp """
+    n11 = np.asarray(n11, dtype=np.float64)
+    n1p = n11 + np.asarray(n12, dtype=np.float64)
+    np1 = n11 + np.asarray(n21, dtype=np.float64)
+    npp = n1p + np.asarray(n21, dtype=np.float64) + np.asarray(n22, dtype=np.float64)
+    return n11, n1p, np1, npp
+
+
+def _log_nbinom(n, e, alpha, beta):
+    """ log marginal likelihood of n given the expected count e and a gamma(alpha, beta) prior """
+    res = special.gammaln(alpha + n) - special.gammaln(alpha) - special.gammaln(n + 1)
+    res -= n*np.log1p(beta/e) + alpha*np.log1p(e/beta)
+    return res
+
+
+def _responsibility(f1, f2, p):
+    """ posterior weight of the first component and the total log likelihood """
+    l1 = np.log(p) + f1
+    l2 = np.log1p(-p) + f2
+    lse = np.logaddexp(l1, l2)
+    return np.exp(l1 - lse), lse.sum()
+
+
+def _fit_gamma(n, e, w, alpha, beta, max_iter:int=20):
+    """ M-step, maximize the weighted log likelihood of a component over log(alpha) and log(beta) """
+    def nll(x):
+        a, b = np.exp(x)
+        f = special.gammaln(a + n) - special.gammaln(a) - n*np.log1p(b/e) - a*np.log1p(e/b)
+        # gradient with respect to log(alpha) and log(beta)
+        ga = special.digamma(a + n) - special.digamma(a) - np.log1p(e/b)
+        gb = -n/(e + b) + a*e/(b*(b + e))
+        return -np.dot(w, f), -np.array([a*np.dot(w, ga), b*np.dot(w, gb)])
+    res = optimize.minimize(
+        nll, np.log([alpha, beta]), jac=True, method="L-BFGS-B",
+        bounds=[(-LOG_BOUND, LOG_BOUND)] * 2, options={"maxiter":max_iter}
+        )
+    return tuple(np.exp(res.x))
+
+
+def _mixture_quantile(prob:float, q, shape:tuple, rate:tuple, n_iter:int=30):
+    """
+    quantile of the mixture of two gammas by vectorized bisection on log scale
+    the quantile lies between those of the components
+
+    """
+    def cdf(x):
+        return q*special.gammainc(shape[0], x*rate[0]) + (1 - q)*special.gammainc(shape[1], x*rate[1])
+    x1 = np.log(special.gammaincinv(shape[0], prob) / rate[0])
+    x2 = np.log(special.gammaincinv(shape[1], prob) / rate[1])
+    lo = np.minimum(x1, x2)
+    hi = np.maximum(x1, x2)
+    for i in range(n_iter):
+        mid = (lo + hi) / 2
+        below = cdf(np.exp(mid)) < prob
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+    return np.exp((lo + hi) / 2)
@@ -15,10 +15,122 @@ import os
 from pathlib import Path
 from tqdm import tqdm
 
+from . import io_handler as ih
+
 FORMAT = ["2014Q3-","2012Q4-2014Q2"]
 
 SEP = os.sep
 
+QUALIFICATION = [
+    'Physician','Pharmacist','Other Health Professional','Lawyer','Consumer or non-health proffesional'
+    ]
+
+### field extraction from a safetyreport ###
+# each converter receives the parent element and the tag of the field
+
+def _get_id(parent, tag):
+    """ text of the indicated child, which must exist """
+    return parent.find(tag).text
+
+def _get_text(parent, tag):
+    """ text of the indicated child or '' if missing """
+    ele = parent.find(tag)
+    if ele is None:
+        return ''
+    return ele.text
+
+def _get_date(parent, tag):
+    """ event date described in the summary """
+    ele = parent.find(tag)
+    if ele is None:
+        return ''
+    return ele[0].text.replace('CASE EVENT DATE: ','')
+
+def _get_sex(parent, tag):
+    """ 1: Male, others: Female """
+    ele = parent.find(tag)
+    if ele is None:
+        return ''
+    if str(ele.text)=='1':
+        return 'Male'
+    return 'Female'
+
+def _get_reactions(parent, tag):
+    """ reactions (PT) concatenated with ';' """
+    reaction = []
+    for w in parent.findall(tag):
+        d = w.find('reactionmeddrapt')
+        if d is not None: # then, d must not be empty
+            reaction.append(d.text)
+    return ";".join(reaction).lower()
+
+def _get_drugs(parent, tag):
+    """ unique active substances concatenated with ';' """
+    drug = [] # drugs in a patient
+    for w in parent.findall(tag):
+        d = w.find('activesubstance')
+        if d is not None:
+            drug += d[0].text.split("\\")
+    return ";".join(list(set(drug))).lower()
+
+def _get_qualification(parent, tag):
+    """ qualification of the reporter """
+    ele = parent.find(tag)
+    if ele is None:
+        return ''
+    return QUALIFICATION[int(ele.text)-1]
+
+# (column, parent, tag, converter)
+# parent is None for the safetyreport itself, otherwise the child visited once per report
+SPEC_2014Q3 = [
+    ('Case ID', None, 'safetyreportid', _get_id),
+    ('Active Substances', 'patient', 'drug', _get_drugs),
+    ('Reactions', 'patient', 'reaction', _get_reactions),
+    ('Sex', 'patient', 'patientsex', _get_sex),
+    ('Event Date', 'patient', 'summary', _get_date),
+    ('Event Country', None, 'occurcountry', _get_text),
+    ('Patient Age', 'patient', 'patientonsetage', _get_text),
+    ('Qualification', 'primarysource', 'qualification', _get_qualification),
+    ]
+
+SPEC_2012Q4_2014Q2 = SPEC_2014Q3[:-1] # no qualification
+
+
+class ReportExtractor():
+    def __init__(self, spec:list=SPEC_2014Q3):
+        """
+        extract all fields of a safetyreport in a single visit
+
+        Parameters
+        ----------
+        spec: list
+            field spec table of (column, parent, tag, converter)
+
+        """
+        self.spec = spec
+        self.columns = [v[0] for v in spec]
+        self.parents = [] # children of safetyreport to be visited
+        for v in spec:
+            if (v[1] is not None) & (v[1] not in self.parents):
+                self.parents.append(v[1])
+        # (index of parent, tag, converter), 0 indicates the safetyreport itself
+        self.__fields = [
+            (0 if v[1] is None else self.parents.index(v[1]) + 1, v[2], v[3]) for v in spec
+            ]
+
+
+    def extract(self, report):
+        """ convert a safetyreport element into a record """
+        find = report.find
+        parents = [report] + [find(p) for p in self.parents]
+        return [fxn(parents[i], tag) for i, tag, fxn in self.__fields]
+
+
+    def to_frame(self, saftyreports:list):
+        """ convert a list of safetyreport elements into a dataframe """
+        records = [self.extract(v) for v in saftyreports]
+        return pd.DataFrame(records, columns=self.columns)
+
 # abstract class
 class XMLoader():
     def __init__(self):
@@ -67,9 +179,12 @@ class XMLoader():
 # concrete class
 class Loader2014Q3_():
     def __init__(self):
-        pass
+        self.__extractor = ReportExtractor(SPEC_2014Q3)
 
-    def load_xml(self, url, to_pickle=False, to_csv=False, fileout="", sep="\t"):
+    def load_xml(
+        self, url, to_pickle=False, to_csv=False, fileout="", sep="\t",
+        stream=False, chunksize=10000
+        ):
         """
         a module for handling the large xml files of FAERS data
         it can be applicable to 2013-2018 data files so far
@@ -90,12 +205,22 @@ class Loader2014Q3_():
         to_csv: boolean
             whether result is exported as csv
 
+        stream: boolean
+            whether the file is parsed with iterparse instead of building the whole tree
+            memory use is bounded by chunksize regardless of the file size
+            with to_csv, records are written chunk by chunk and None is returned
+
+        chunksize: int
+            the number of safetyreports parsed at once in the stream mode
+
         """
         if len(fileout)==0:            
             if to_pickle:
                 fileout = os.path.dirname(url) + SEP + os.path.basename(url).replace('xml','pkl')
             elif to_csv:
                 fileout = os.path.dirname(url) + SEP + os.path.basename(url).replace('xml','txt')   
+        if stream:
+            return self._stream_xml(url, to_pickle, to_csv, fileout, sep, chunksize)
 
         #file loading
         tree = ET.parse(url) #consume ~2GB
@@ -108,129 +233,8 @@ class Loader2014Q3_():
         #att_2nd = [v.attrib for v in root]
         saftyreports = [v for v in root] #the 1st one is the header
         del saftyreports[0]
-        
-        #case ID
-        caseID = [v.find('safetyreportid').text for v in saftyreports]
-        
-        #event country
-        event_country = []
-        ap = event_country.append
-        for v in saftyreports:
-            ele = v.find('occurcountry')
-            if ele is None:
-                ap('')
-            else:
-                ap(ele.text)
-        del ele,v
-        
-        #event date
-        event_date = []
-        ap = event_date.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.find('summary')
-            if c is None:
-                ap('')
-            else:
-                ap(c[0].text.replace('CASE EVENT DATE: ',''))
-        del v,b,c
-        
-        #age
-        age = []
-        ap = age.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.find('patientonsetage')
-            if c is None:
-                ap('')
-            else:
-                ap(c.text)
-        del v,b,c
-        
-        #sex
-        sex = []
-        ap = sex.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.find('patientsex')
-            if c is None:
-                ap('')
-            else:
-                if str(c.text)=='1':
-                    ap('Male')
-                else:
-                    ap('Female')
-        del v,b,c
-        
-        #adverse reactions
-        reactions = []
-        ap = reactions.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.findall('reaction')
-            reaction = ""
-            for w in c:
-                d = w.find('reactionmeddrapt')
-                if d is not None: # then, d must not be empty
-                    if len(reaction)==0:
-                        reaction += d.text
-                    else:
-                        reaction += ";" + d.text
-            ap(reaction)
-        del v,b,c
-        reactions = [v.lower() for v in reactions]
-
-        #suspected drugs
-        drugs = []
-        ap = drugs.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.findall('drug')
-            drug = [] # drugs in a patient
-            for w in c:
-                d = w.find('activesubstance')
-                if d is not None:
-                    drug += d[0].text.split("\\")
-            drug = list(set(drug))
-            if len(drug)==0:
-                ap("")
-            elif len(drug)==1:
-                ap(drug[0])
-            else:
-                drug2 = drug[0]
-                for w in drug[1:]:
-                    drug2 += ";" + w
-                ap(drug2)
-        del v, b, c
-        drugs = [v.lower() for v in drugs]
-        
-        # qualification
-        qualifications = []
-        ap = qualifications.append
-        candi_list = [
-            'Physician','Pharmacist','Other Health Professional','Lawyer','Consumer or non-health proffesional'
-            ]
-        for v in saftyreports:
-            b = v.find('primarysource')
-            c = b.find('qualification')
-            if c is None:
-                ap('')
-            else:
-                ap(candi_list[int(c.text)-1])
-        del v,b,c
-
-        # export data
-        data = pd.DataFrame(
-            {'Case ID':caseID,
-             'Active Substances':drugs,
-             'Reactions':reactions,
-             'Sex':sex,
-             'Event Date':event_date,
-             'Event Country':event_country,
-             'Patient Age':age,
-             'Qualification':qualifications,}
-             )
-        del tree,root,event_country,event_date,age,sex,caseID,drugs,saftyreports,reactions,qualifications
+        data = self._parse_reports(saftyreports)
+        del tree,root,saftyreports
         data = data.reset_index(drop=True) # modify 230731, to keep case ID
         if to_pickle:
             data.to_pickle(fileout)
@@ -239,10 +243,68 @@ class Loader2014Q3_():
         return data
 
 
+    def iter_reports(self, url, chunksize=10000):
+        """
+        parse the xml file with iterparse and yield the records chunk by chunk
+        each safetyreport is detached from the root once it is closed,
+        so that only the reports of the current chunk are kept in memory
+
+        Parameters
+        ----------
+        url: str
+            a path for xml file from FAERS
+
+        chunksize: int
+            the number of safetyreports in a chunk
+
+        """
+        context = ET.iterparse(url, events=("start", "end"))
+        _, root = next(context) # ichicsr, the only start event needed
+        ends = (elem for event, elem in context if event == "end")
+        chunk = []
+        n_yield = 0
+        for elem in ends:
+            if elem.tag == "safetyreport":
+                chunk.append(elem)
+                root.clear() # drop the closed reports (and the header) from the root
+                if len(chunk) >= chunksize:
+                    yield self._parse_reports(chunk)
+                    n_yield += 1
+                    chunk = []
+        if (len(chunk) > 0) | (n_yield == 0):
+            yield self._parse_reports(chunk)
+
+
+    def _stream_xml(self, url, to_pickle, to_csv, fileout, sep, chunksize):
+        """ stream mode of load_xml """
+        if to_csv & (not to_pickle):
+            mode = "w"
+            try:
+                for chunk in self.iter_reports(url, chunksize):
+                    chunk.to_csv(fileout, index=False, sep=sep, mode=mode, header=(mode == "w"))
+                    mode = "a"
+            except Exception:
+                # do not leave a partially parsed file
+                if os.path.exists(fileout):
+                    os.remove(fileout)
+                raise
+            return None
+        data = pd.concat(list(self.iter_reports(url, chunksize)), axis=0)
+        data = data.reset_index(drop=True)
+        if to_pickle:
+            data.to_pickle(fileout)
+        return data
+
+
+    def _parse_reports(self, saftyreports:list):
+        """ convert a list of safetyreport elements into a dataframe """
+        return self.__extractor.to_frame(saftyreports)
+
+
 # concrete class
 class Loader2012Q4_2014Q2():
     def __init__(self):
-        pass
+        self.__extractor = ReportExtractor(SPEC_2012Q4_2014Q2)
 
     def load_xml(self, url, to_pickle=False, to_csv=False, fileout="", sep="\t"):
         """
@@ -268,119 +330,36 @@ class Loader2012Q4_2014Q2():
         saftyreports = [v for v in root] #the 1st one is the header
         del saftyreports[0]
         
-        #case ID
-        caseID = [v.find('safetyreportid').text for v in saftyreports]
-        
-        #event country
-        event_country = []
-        ap = event_country.append
-        for v in saftyreports:
-            ele = v.find('occurcountry')
-            if ele is None:
-                ap('')
-            else:
-                ap(ele.text)
-        del ele,v
-        
-        # event date
-        # 230801, summary is empty. maybe the query is wrong
-        event_date = []
-        ap = event_date.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.find('summary')
-            if c is None:
-                ap('')
-            else:
-                ap(c[0].text.replace('CASE EVENT DATE: ',''))
-        del v,b,c
-        
-        #age
-        age = []
-        ap = age.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.find('patientonsetage')
-            if c is None:
-                ap('')
-            else:
-                ap(c.text)
-        del v,b,c
-        
-        #sex
-        sex = []
-        ap = sex.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.find('patientsex')
-            if c is None:
-                ap('')
-            else:
-                if str(c.text)=='1':
-                    ap('Male')
-                else:
-                    ap('Female')
-        del v,b,c
-        
-        #adverse reactions
-        reactions = []
-        ap = reactions.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.findall('reaction')
-            reaction = ""
-            for w in c:
-                d = w.find('reactionmeddrapt')
-                if d is not None:
-                    if len(reaction)==0:
-                        reaction += d.text
-                    else:
-                        reaction += ";" + d.text
-            ap(reaction)
-        del v,b,c
-        reactions = [v.lower() for v in reactions]
-
-
-        # suspected drugs
-        # 230801, drug is empty. maybe the query (activesubstance) is wrong
-        drugs = []
-        ap = drugs.append
-        for v in saftyreports:
-            b = v.find('patient')
-            c = b.findall('drug')
-            drug = [] # drugs in a patient
-            for w in c:
-                d = w.find('activesubstance')
-                if d is not None:
-                    drug += d[0].text.split("\\")
-            drug = list(set(drug))
-            if len(drug)==0:
-                ap("")
-            elif len(drug)==1:
-                ap(drug[0])
-            else:
-                drug2 = drug[0]
-                for w in drug[1:]:
-                    drug2 += ";" + w
-                ap(drug2)
-        del v,b,c
-        drugs = [v.lower() for v in drugs]
-        
-
-        #export data
-        data = pd.DataFrame(
-            {'Case ID':caseID,
-             'Active Substances':drugs,
-             'Reactions':reactions,
-             'Sex':sex,
-             'Event Date':event_date,
-             'Event Country':event_country,
-             'Patient Age':age}
-             )
-        del tree,root,event_country,event_date,age,sex,caseID,drugs,saftyreports,reactions
+        # 230801, summary (event date) and activesubstance (drugs) are empty
+        # maybe the queries are wrong
+        data = self.__extractor.to_frame(saftyreports)
+        del tree,root,saftyreports
         data = data.reset_index(drop=True) # modify 230731, to keep case ID
         if to_pickle:
             data.to_pickle(fileout)
         elif to_csv:
             data.to_csv(fileout, index=False, sep=sep)
-        return data
\ No newline at end of file
+        return data
+
+def parse_file(url, fileout, stream=False, sep="\t", fmt="tsv"):
+    """
+    parse a FAERS xml file of 2014Q3- into a tsv or parquet file
+    a module-level entry point so that it can be sent to process pools
+    errors are returned instead of raised to be summarized by the caller
+
+    Returns
+    -------
+    tuple of (url, error message or None)
+
+    """
+    try:
+        dat = Loader2014Q3_()
+        if fmt == "tsv":
+            dat.load_xml(url, fileout=fileout, to_csv=True, sep=sep, stream=stream)
+        elif stream:
+            ih.write_chunks(dat.iter_reports(url), fileout, "parsed", fmt)
+        else:
+            ih.write_table(dat.load_xml(url), fileout, "parsed", fmt)
+        return url, None
+    except Exception as e:
+        return url, f"{type(e).__name__}: {e}"